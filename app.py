@@ -1,10 +1,15 @@
 import json
 import dash_leaflet as dl
-import dash_leaflet.express as dlx
-from dash import Dash, html, dcc, Input, Output, dash_table
+from dash import Dash, html, dcc, Input, Output, State, ALL, dash_table, callback_context
 import dash_bootstrap_components as dbc
 from dash_extensions.javascript import assign
-import pandas as pd
+
+from datasets import active
+import instrumentation
+from incremental import METRICS
+from payloads import N_VALUES, color_prop
+from scoring import is_default, quantize_weights
+from table_query import query_page
 
 
 # Set styling
@@ -21,36 +26,33 @@ external_stylesheets = [
 # Set color properties
 colorscale = ['red', 'yellow', 'green']#, 'blue', 'purple']  # rainbow
 chroma = "https://cdnjs.cloudflare.com/ajax/libs/chroma-js/2.1.0/chroma.min.js"  # js lib used for colors
-color_prop = 'rank'
 
 # js function for adding points to layers
 point_to_layer = assign("""function(feature, latlng, context){
-        const {min, max, colorscale, circleOptions, colorProp} = context.props.hideout;
-        const csc = chroma.scale(colorscale).domain([min, max]);  // chroma lib to construct colorscale
-        circleOptions.fillColor = csc(feature.properties[colorProp]);  // set color based on color prop.
-        return L.circleMarker(latlng, circleOptions);  // sender a simple circle marker.
+        const {min, max, colorscale, circleOptions, colorProp, selected} = context.props.hideout;
+        if (context._cscHideout !== context.props.hideout) {
+            // chroma lib to construct colorscale, once per hideout rather than once per point
+            context._csc = chroma.scale(colorscale).domain([min, max]);
+            context._cscHideout = context.props.hideout;
+        }
+        const csc = context._csc;
+        if (feature.properties.cluster) {
+            // Clusters are computed server side, colorProp holds the mean rank of the leaves.
+            const icon = L.divIcon.scatter({
+                html: '<div style="background-color:white;"><span>' + feature.properties.point_count_abbreviated + '</span></div>',
+                className: "marker-cluster",
+                iconSize: L.point(40, 40),
+                color: csc(feature.properties[colorProp])
+            });
+            return L.marker(latlng, {icon : icon});
+        }
+        const options = Object.assign({}, circleOptions, {fillColor: csc(feature.properties[colorProp])});  // set color based on color prop.
+        if (selected && Math.abs(latlng.lat - selected[0]) < 1e-6 && Math.abs(latlng.lng - selected[1]) < 1e-6) {
+            Object.assign(options, {stroke: true, color: 'black', weight: 3, fillOpacity: 0.9});  // row picked in the table
+        }
+        return L.circleMarker(latlng, options);  // sender a simple circle marker.
     }""")
 
-cluster_to_layer = assign("""function(feature, latlng, index, context){
-    const {min, max, colorscale, circleOptions, colorProp} = context.props.hideout;
-    const csc = chroma.scale(colorscale).domain([min, max]);
-    // Set color based on mean value of leaves.
-    const leaves = index.getLeaves(feature.properties.cluster_id);
-    let valueSum = 0;
-    for (let i = 0; i < leaves.length; ++i) {
-        valueSum += leaves[i].properties[colorProp]
-    }
-    const valueMean = valueSum / leaves.length;
-    // Render a circle with the number of leaves written in the center.
-    const icon = L.divIcon.scatter({
-        html: '<div style="background-color:white;"><span>' + feature.properties.point_count_abbreviated + '</span></div>',
-        className: "marker-cluster",
-        iconSize: L.point(40, 40),
-        color: csc(valueMean)
-    });
-    return L.marker(latlng, {icon : icon})
-}""")
-
 # instantiate app
 app = Dash(__name__,
         external_stylesheets=external_stylesheets,
@@ -59,115 +61,285 @@ app = Dash(__name__,
 
 server = app.server
 
+# Parse every level and encode every map payload once when the worker starts
+active.dataset.warm()
+# The data routes always answer from the dataset being served
+active.dataset.routes.register(server, lambda: active.dataset.routes)
+instrumentation.register(server)
+
+static_text = """
+The purpose of the dashboard is to determine which areas will benefit the most from trees being planted based on the aggregation of various metrics.  
+
+The dashboard allows for the aggregation of data on a census tract, county, city and state level.  
+
+Within each level, each location has been ranked by aggregating important variables from the Climate and Economic Justice Screening tool data, with the #1 ranked location being identified as the area most likely to benefit from the planting of trees.  
+"""
+
+level_options = [
+    {'label':'Census Tract', 'value':'census_tract'},
+    {'label':'County', 'value':'county'},
+    {'label':'City', 'value': 'city'},
+    {'label':'State', 'value':'state'}
+]
+
+default_type = 'city'
+default_clustered = ['census_tract']  # levels drawn as server-side clusters
+default_n = 20
+page_size = 10
+
+
+def table_columns(df):
+    return [{"name": i.title(), "id": i} for i in df.columns if not i in ('lat', 'lon', 'description')]
+
+
+def parse_n(n_values):
+    # 'all' selects every location of the level
+    return None if n_values == 'all' else n_values
+
+
+# Shown instead of silently ignoring the sliders when a level has no metric sums
+weights_note = 'Weights are unavailable for this level until its metrics artifact is published (see precompute.py).'
+
+
+def ranking_source(dataset, data_type, weights):
+    # Equal weights are the notebook's own ranking, other weights re-rank from the metric sums
+    key = quantize_weights(weights)
+    if is_default(key) or not dataset.weights.available(data_type):
+        return dataset.centres, dataset.payloads
+    view = dataset.weights.view(key)
+    return view, view.payloads
+
+
+def table_frame(source, data_type, n_values, scope):
+    # Rows the table can browse: the mapped locations or the whole level
+    if scope == 'all':
+        return source.frame(data_type)
+    return source.top_n(data_type, parse_n(n_values))
+
+
+def map_hideout(vmax):
+    # Only max and selected change afterwards, and those are set in the browser
+    return dict(colorProp=color_prop, circleOptions=dict(fillOpacity=0.6, stroke=False, radius=20),
+                min=0, max=vmax, colorscale=colorscale, selected=None)
+
+
+def serve_layout():
+    # Built on every page load from the dataset being served, so a swapped-in
+    # version shows its own data URL, table page and colour range.
+    # Later callbacks only patch the data.
+    dataset = active.dataset
+    initial_payload = dataset.payloads.get(default_type, default_n)
+    initial_df = dataset.centres.top_n(default_type, default_n)
+    initial_page, initial_page_count = query_page(initial_df, 0, page_size)
+    weighted = dataset.weights.available(default_type)
+
+    # Geojson rendering logic, must be JavaScript as it is executed in clientside.
+    # The geobuf is fetched from the cacheable data route, inline data takes precedence over the url
+    geojson = dl.GeoJSON(url=dataset.routes.map_url(default_type, default_n), id="geojson", format="geobuf",
+                         zoomToBounds=False,  # data follows the viewport, so don't zoom when it changes
+                         zoomToBoundsOnClick=False,  # cluster markers have no bounds, clicks are handled below
+                         options=dict(pointToLayer=point_to_layer),  # how to draw points and clusters
+                         hideout=map_hideout(initial_payload.vmax))
+
+    colorbar = dl.Colorbar(id='colorbar', colorscale=colorscale, width=20, height=150, min=0, max=initial_payload.vmax, unit='Rank')
+
+    return html.Div([
+        dbc.Row([
+            dbc.Col(html.Div(html.Img(src='/assets/sage_logo.png',style={'maxWidth': '50%'}), style={'textAlign': 'center'})),
+            dbc.Col(html.H1('One Tree Planted - Sage Hackathon', style={'textAlign': 'center'})),
+            dbc.Col(html.Div(html.Img(src='/assets/one_tree_planted_logo.png',style={'maxWidth': '50%'}), style={'textAlign': 'center'})),
+            ], justify="center", align="center", className="h-50"),
+        dbc.Row([
+            dbc.Col(html.H4('Select level of aggregation:'), width={'size':2, 'offset':0}),
+            dbc.Col(html.H4('Select number of locations to show:'), width={'size':2, 'offset':0})
+            ], justify="center", align="center", className="h-50"),
+        dbc.Row([
+             dbc.Col(dcc.Dropdown(
+                    level_options,
+                    default_type,
+                    id='data-type',
+                    clearable=False,
+                    #inline=False
+                    ), width={'size':2, 'offset':0}),
+             dbc.Col(dcc.Dropdown(
+                 [{'label': str(n), 'value': n} for n in N_VALUES] + [{'label': 'All', 'value': 'all'}], default_n,
+                 id='n-dropdown',
+                 clearable=False
+                 ),width={'size':2, 'offset':0}),
+             ],justify="center", align="center", className="h-50"),
+        dbc.Row([
+             dbc.Col(html.H6('Cluster locations for:'), width={'size':'auto', 'offset':0}),
+             dbc.Col(dcc.Checklist(
+                 level_options,
+                 default_clustered,
+                 id='cluster-levels',
+                 inline=True
+                 ), width={'size':'auto', 'offset':0}),
+             ],justify="center", align="center", className="h-50", style={'marginTop':'10px'}),
+        dbc.Row([
+             dbc.Col([
+                 html.H6(metric.replace('_', ' ')),
+                 dcc.Slider(0, 2, 0.1, value=1, marks={0: '0', 1: '1', 2: '2'},
+                            id={'type': 'weight', 'metric': metric}, disabled=not weighted)
+                 ], width={'size':1, 'offset':0})
+             for metric in METRICS
+             ],justify="center", align="end", style={'marginTop':'10px'}),
+        dbc.Row(
+            dbc.Col(html.Small(weights_note, id='weights-note', hidden=weighted), width='auto'),
+            justify="center"),
+        html.Div(
+            dl.Map([dl.TileLayer(), geojson, colorbar], id='map', center=(40.32, -101.18), zoom=3, style={'width': '83%', 'height': '50vh', 'margin': "auto", "display": "block"}),
+            id='map-data', style={'marginTop':'10px'}),
+        dcc.Store(id='map-range', data=initial_payload.vmax),
+        html.Div(
+            dbc.Row([
+                dbc.Col(dcc.Markdown(static_text, style={'font-size':'18px'}), width={'size':4, 'offset':1}),
+                dbc.Col([
+                    dcc.RadioItems(
+                        [
+                            {'label': 'Mapped locations', 'value': 'mapped'},
+                            {'label': 'All locations', 'value': 'all'}
+                        ],
+                        'mapped',
+                        id='table-scope',
+                        inline=True
+                    ),
+                    # Filtering, sorting and paging run server side on the cached frames
+                    dash_table.DataTable(initial_page.to_dict('records'),
+                    table_columns(initial_df),
+                    id='ranking-table',
+                    editable=True,
+                    filter_action="custom",
+                    sort_action="custom",
+                    sort_mode='multi',
+                    page_action='custom',
+                    page_current= 0,
+                    page_size= page_size,
+                    page_count=initial_page_count,
+                    )],
+                width={'size':5, 'offset':1})
+            ]),
+            id='data-table', style={'marginTop': '20px'})
+        ])
+
+
+
 # Create app layout
-app.layout = html.Div([
-    dbc.Row([
-        dbc.Col(html.Div(html.Img(src='/assets/sage_logo.png',style={'maxWidth': '50%'}), style={'textAlign': 'center'})),
-        dbc.Col(html.H1('One Tree Planted - Sage Hackathon', style={'textAlign': 'center'})),
-        dbc.Col(html.Div(html.Img(src='/assets/one_tree_planted_logo.png',style={'maxWidth': '50%'}), style={'textAlign': 'center'})),
-        ], justify="center", align="center", className="h-50"),
-    dbc.Row([
-        dbc.Col(html.H4('Select level of aggregation:'), width={'size':2, 'offset':0}),
-        dbc.Col(html.H4('Select number of locations to show:'), width={'size':2, 'offset':0})
-        ], justify="center", align="center", className="h-50"),
-    dbc.Row([
-         dbc.Col(dcc.Dropdown(
-             [
-                 {'label':'Census Tract', 'value':'census_tract'},
-                 {'label':'County', 'value':'county'},
-                 {'label':'City', 'value': 'city'},
-                 {'label':'State', 'value':'state'}
-             ],
-                'city',
-                id='data-type',
-                #inline=False
-                ), width={'size':2, 'offset':0}),
-         dbc.Col(dcc.Dropdown(
-             [20,50,100,200,500], 20,
-             id='n-dropdown'
-             ),width={'size':2, 'offset':0}),
-         ],justify="center", align="center", className="h-50"),
-    html.Div(id='map-data', style={'marginTop':'10px'}),
-    html.Div(id='data-table', style={'marginTop': '20px'})
-    ])
-    
+app.layout = serve_layout
 
 @app.callback([
-    Output('map-data', 'children'),
-    Output('data-table', 'children')
+    Output({'type': 'weight', 'metric': ALL}, 'disabled'),
+    Output('weights-note', 'hidden')
+    ],
+    Input('data-type', 'value'),
+    prevent_initial_call=True
+)
+def update_weights(data_type):
+    # The sliders only re-rank levels with per-group metric sums
+    weighted = active.dataset.weights.available(data_type)
+    return [not weighted] * len(METRICS), weighted
+
+
+@app.callback([
+    Output('geojson', 'data'),
+    Output('geojson', 'url'),
+    Output('map-range', 'data')
     ],
     [Input('data-type', 'value'),
-     Input('n-dropdown', 'value')
-    ]
+     Input('n-dropdown', 'value'),
+     Input('map', 'bounds'),
+     Input('map', 'zoom'),
+     Input('cluster-levels', 'value'),
+     Input({'type': 'weight', 'metric': ALL}, 'value')
+    ],
+    prevent_initial_call=True
 )
-def update_map(data_type, n_values):
+def update_map(data_type, n_values, bounds, zoom, clustered, weights):
+    with instrumentation.callback('update_map', data_type):
+        dataset = active.dataset  # one version for the whole request
+        _, payloads = ranking_source(dataset, data_type, weights)
+        if data_type in (clustered or []):
+            # Pre-computed clusters for the current zoom
+            payload = payloads.clusters(data_type, parse_n(n_values), bounds, zoom)
+        else:
+            # Only the locations inside the viewport, pre-encoded when it shows the whole top N
+            payload = payloads.viewport(data_type, parse_n(n_values), bounds, zoom)
+        url = dataset.routes.map_url(data_type, parse_n(n_values), payload) if payloads is dataset.payloads else None
+    if url is None:
+        # Viewport subsets, clusters and weighted rankings are sent inline
+        return payload.geobuf, None, payload.vmax
+    # The whole pre-built top N is fetched from the cacheable data route
+    return None, url, payload.vmax
 
-    tooltip_prop = {
-        'census_tract': 'GEOID10',
-        'county': 'CF',
-        'state': 'SF',
-        'city': 'city'
-    }
 
-    #if data_type != 'city':
-    #    df = pd.read_csv(f'{data_type}_centres.csv', index_col=0)  
-    #else:
-    df = pd.read_csv(f'{data_type}_centres.csv')  
-
-    df = df.sort_values('rank').iloc[:n_values].dropna()
-
-    dicts = df.to_dict('records')
-    for item in dicts:
-        item['tooltip'] = '{} <br> {}'.format(item[data_type], item['description']) # bind tooltip
-    
-
-    static_text = """
-    The purpose of the dashboard is to determine which areas will benefit the most from trees being planted based on the aggregation of various metrics.  
-
-    The dashboard allows for the aggregation of data on a census tract, county, city and state level.  
-
-    Within each level, each location has been ranked by aggregating important variables from the Climate and Economic Justice Screening tool data, with the #1 ranked location being identified as the area most likely to benefit from the planting of trees.  
-    """
-
-    # Data for table
-    data_table = dbc.Row([
-        dbc.Col(dcc.Markdown(static_text, style={'font-size':'18px'}), width={'size':4, 'offset':1}),
-        dbc.Col(
-            dash_table.DataTable(df.to_dict('records'), 
-            [{"name": i.title(), "id": i} for i in df.columns if not i in ('lat', 'lon', 'description')],
-            editable=True,
-            filter_action="native",
-            sort_action="native",
-            sort_mode='multi',
-            page_action='native',
-            page_current= 0,
-            page_size= 10,
-            ), 
-        width={'size':5, 'offset':1})
-    ])
-
-    geojson = dlx.dicts_to_geojson(dicts)
-    geobuf = dlx.geojson_to_geobuf(geojson)  
-
-    vmax = df[color_prop].max()
-    colorbar = dl.Colorbar(colorscale=colorscale, width=20, height=150, min=0, max=vmax, unit='Rank')
+# Colour range, colorbar and the marker of the selected table row are updated in the browser
+app.clientside_callback(
+    """function(vmax, activeCell, rows, hideout){
+        const row = activeCell && rows ? rows[activeCell.row] : null;
+        const selected = row ? [row.lat, row.lon] : null;
+        if (hideout.max === vmax && JSON.stringify(hideout.selected) === JSON.stringify(selected)) {
+            return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+        }
+        return [Object.assign({}, hideout, {max: vmax, selected: selected}), vmax];
+    }""",
+    [Output('geojson', 'hideout'),
+     Output('colorbar', 'max')
+    ],
+    [Input('map-range', 'data'),
+     Input('ranking-table', 'active_cell')
+    ],
+    [State('ranking-table', 'data'),
+     State('geojson', 'hideout')
+    ],
+    prevent_initial_call=True
+)
 
-    # Geojson rendering logic, must be JavaScript as it is executed in clientside.
 
-    geojson = dl.GeoJSON(data=geobuf, id="geojson", format="geobuf",
-                     zoomToBounds=True,  # when true, zooms to bounds when data changes
-                     #cluster=True,
-                     zoomToBoundsOnClick=True,
-                     #clusterToLayer=cluster_to_layer,  # how to draw points
-                     options=dict(pointToLayer=point_to_layer),
-                     #superClusterOptions=dict(radius=150),   # adjust cluster size
-                     hideout=dict(colorProp=color_prop, circleOptions=dict(fillOpacity=0.6, stroke=False, radius=20),
-                                  min=0, max=vmax, colorscale=colorscale))
+# Clicking a server-side cluster zooms in to where it splits up, as supercluster's click handler did
+app.clientside_callback(
+    """function(feature){
+        if (!feature || !feature.properties.cluster) {
+            return window.dash_clientside.no_update;
+        }
+        const [lon, lat] = feature.geometry.coordinates;
+        return {center: [lat, lon], zoom: feature.properties.expansion_zoom};
+    }""",
+    Output('map', 'viewport'),
+    Input('geojson', 'click_feature'),
+    prevent_initial_call=True
+)
+
 
+@app.callback([
+    Output('ranking-table', 'data'),
+    Output('ranking-table', 'columns'),
+    Output('ranking-table', 'page_count'),
+    Output('ranking-table', 'page_current')
+    ],
+    [Input('data-type', 'value'),
+     Input('n-dropdown', 'value'),
+     Input('table-scope', 'value'),
+     Input('ranking-table', 'page_current'),
+     Input('ranking-table', 'page_size'),
+     Input('ranking-table', 'sort_by'),
+     Input('ranking-table', 'filter_query'),
+     Input({'type': 'weight', 'metric': ALL}, 'value')
+    ],
+    prevent_initial_call=True
+)
+def update_table(data_type, n_values, scope, page_current, page_size, sort_by, filter_query, weights):
+    # Start from the first page whenever the rows change, only paging keeps the page
+    triggered = [t['prop_id'] for t in callback_context.triggered]
+    if not all(t in ('ranking-table.page_current', 'ranking-table.page_size') for t in triggered):
+        page_current = 0
 
-    return dl.Map([dl.TileLayer(), geojson, colorbar], center=(40.32, -101.18), zoom=3, style={'width': '83%', 'height': '50vh', 'margin': "auto", "display": "block"}), data_table
+    with instrumentation.callback('update_table', data_type):
+        source, _ = ranking_source(active.dataset, data_type, weights)
+        df = table_frame(source, data_type, n_values, scope)
+        page, page_count = query_page(df, page_current or 0, page_size, sort_by, filter_query)
+        return page.to_dict('records'), table_columns(df), page_count, min(page_current or 0, page_count - 1)
 
 
 if __name__ == '__main__':
+    active.watch()
     app.run_server(debug=True)
-
@@ -0,0 +1,133 @@
+"""Versioned, checksummed artifact directories.
+
+Every run of the precompute job (or of the notebook's export) writes a
+complete set of level artifacts into its own version directory:
+
+    <root>/versions/<version>/<level>_centres.arrow
+    <root>/versions/<version>/<level>_metrics.arrow
+    <root>/versions/<version>/manifest.json
+    <root>/CURRENT
+
+A version is written into a hidden staging directory, its files are
+checksummed into ``manifest.json`` and the directory is renamed into
+place. Only then is ``CURRENT`` replaced to name it, so readers never see
+a partially written version. Published versions are never modified.
+"""
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import time
+
+
+MANIFEST = 'manifest.json'
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_atomic(path, data):
+    """Write ``data`` (text or bytes) next to ``path`` and rename it into place.
+
+    Replacing the file rather than rewriting it leaves other links to the
+    old file, such as those of a base version, untouched.
+    """
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class ArtifactStore:
+    """Version directories under ``root`` and the pointer to the current one."""
+
+    def __init__(self, root, keep=3):
+        self.root = root
+        self.keep = keep
+        self.versions_dir = os.path.join(root, 'versions')
+
+    def path(self, version):
+        return os.path.join(self.versions_dir, version)
+
+    def current(self):
+        """Return the name of the current version, or None before the first publish."""
+        try:
+            with open(os.path.join(self.root, 'CURRENT')) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def versions(self):
+        """Published versions, oldest first."""
+        if not os.path.isdir(self.versions_dir):
+            return []
+        return sorted(v for v in os.listdir(self.versions_dir) if not v.startswith('.'))
+
+    def manifest(self, version):
+        with open(os.path.join(self.path(version), MANIFEST)) as f:
+            return json.load(f)
+
+    def verify(self, version):
+        """Check every file of a version against its manifest, raising ValueError on a mismatch."""
+        manifest = self.manifest(version)
+        for name, expected in manifest['files'].items():
+            path = os.path.join(self.path(version), name)
+            if not os.path.exists(path):
+                raise ValueError(f'{version}: {name} is missing')
+            if os.path.getsize(path) != expected['bytes'] or file_sha1(path) != expected['sha1']:
+                raise ValueError(f'{version}: {name} does not match its checksum')
+        return manifest
+
+    @contextmanager
+    def new_version(self, base=None, **metadata):
+        """Yield a staging directory and publish it as the current version on success.
+
+        With ``base`` the staging directory starts with the files of that
+        version, so a partial update only writes what changed. ``metadata``
+        is recorded in the manifest. If the block raises, the staging
+        directory is removed and the current version is unchanged.
+        """
+        # Names sort in publishing order, down to the microsecond
+        now = time.time()
+        version = time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)) + f'{int(now * 1e6) % 1000000:06d}Z-' + secrets.token_hex(3)
+        staging = os.path.join(self.versions_dir, f'.{version}')
+        os.makedirs(staging)
+        try:
+            if base is not None:
+                for name in self.manifest(base)['files']:
+                    # Published files are never modified and writers replace rather than rewrite, so links are safe
+                    source, target = os.path.join(self.path(base), name), os.path.join(staging, name)
+                    try:
+                        os.link(source, target)
+                    except OSError:
+                        shutil.copy2(source, target)
+            yield staging
+            files = {
+                name: {'sha1': file_sha1(os.path.join(staging, name)),
+                       'bytes': os.path.getsize(os.path.join(staging, name))}
+                for name in sorted(os.listdir(staging))
+            }
+            manifest = {'version': version, 'base': base, 'created': time.time(), 'files': files, **metadata}
+            write_atomic(os.path.join(staging, MANIFEST), json.dumps(manifest, indent=2))
+            os.rename(staging, self.path(version))
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        write_atomic(os.path.join(self.root, 'CURRENT'), version)
+        self.prune()
+
+    def prune(self):
+        """Remove all but the ``keep`` newest versions, never the current one."""
+        current = self.current()
+        for version in self.versions()[:-self.keep]:
+            if version != current:
+                shutil.rmtree(self.path(version), ignore_errors=True)
@@ -6,38 +6,39 @@ window.dashExtensions = Object.assign({}, window.dashExtensions, {
                 max,
                 colorscale,
                 circleOptions,
-                colorProp
+                colorProp,
+                selected
             } = context.props.hideout;
-            const csc = chroma.scale(colorscale).domain([min, max]); // chroma lib to construct colorscale
-            circleOptions.fillColor = csc(feature.properties[colorProp]); // set color based on color prop.
-            return L.circleMarker(latlng, circleOptions); // sender a simple circle marker.
-        },
-        function1: function(feature, latlng, index, context) {
-            const {
-                min,
-                max,
-                colorscale,
-                circleOptions,
-                colorProp
-            } = context.props.hideout;
-            const csc = chroma.scale(colorscale).domain([min, max]);
-            // Set color based on mean value of leaves.
-            const leaves = index.getLeaves(feature.properties.cluster_id);
-            let valueSum = 0;
-            for (let i = 0; i < leaves.length; ++i) {
-                valueSum += leaves[i].properties[colorProp]
+            if (context._cscHideout !== context.props.hideout) {
+                // chroma lib to construct colorscale, once per hideout rather than once per point
+                context._csc = chroma.scale(colorscale).domain([min, max]);
+                context._cscHideout = context.props.hideout;
+            }
+            const csc = context._csc;
+            if (feature.properties.cluster) {
+                // Clusters are computed server side, colorProp holds the mean rank of the leaves.
+                const icon = L.divIcon.scatter({
+                    html: '<div style="background-color:white;"><span>' + feature.properties.point_count_abbreviated + '</span></div>',
+                    className: "marker-cluster",
+                    iconSize: L.point(40, 40),
+                    color: csc(feature.properties[colorProp])
+                });
+                return L.marker(latlng, {
+                    icon: icon
+                });
+            }
+            const options = Object.assign({}, circleOptions, {
+                fillColor: csc(feature.properties[colorProp])
+            }); // set color based on color prop.
+            if (selected && Math.abs(latlng.lat - selected[0]) < 1e-6 && Math.abs(latlng.lng - selected[1]) < 1e-6) {
+                Object.assign(options, {
+                    stroke: true,
+                    color: 'black',
+                    weight: 3,
+                    fillOpacity: 0.9
+                }); // row picked in the table
             }
-            const valueMean = valueSum / leaves.length;
-            // Render a circle with the number of leaves written in the center.
-            const icon = L.divIcon.scatter({
-                html: '<div style="background-color:white;"><span>' + feature.properties.point_count_abbreviated + '</span></div>',
-                className: "marker-cluster",
-                iconSize: L.point(40, 40),
-                color: csc(valueMean)
-            });
-            return L.marker(latlng, {
-                icon: icon
-            })
+            return L.circleMarker(latlng, options); // sender a simple circle marker.
         }
     }
 });
\ No newline at end of file
@@ -0,0 +1,436 @@
+"""Latency benchmark for the dashboard callbacks.
+
+Drives ``/_dash-update-component`` through Flask's test client for every
+(data_type, n_values) combination and records p50/p95/p99 latency,
+response bytes and the peak RSS of the process, which plays the part of
+one gunicorn worker. A map callback that answers with a ``/data`` URL is
+followed by fetching that URL, as a browser with an empty cache does, so
+latency and bytes include the payload. With ``--url`` the same requests
+are sent over HTTP to a running deployment (e.g. ``gunicorn app:server``)
+from several threads to measure the requests per second it sustains;
+its memory is only reported for the worker processes passed with
+``--pid``.
+
+    python benchmark.py run --output before.json
+    python benchmark.py run --output after.json
+    python benchmark.py compare before.json after.json
+
+``startup`` checks cold start against a budget: it imports the app the
+way the preloading gunicorn master does (see gunicorn.conf.py), forks a
+worker that serves every level, and reports the import time, the
+slowest imports, the master's RSS and the memory the worker did not
+share with the master.
+
+    python benchmark.py startup --max-import-s 10 --max-worker-private-mb 150
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import gc
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+
+PERCENTILES = (50, 95, 99)
+
+# Map bounds of a national view and of a zoomed-in region
+NATIONAL = [[15.0, -140.0], [60.0, -60.0]]
+REGIONAL = [[38.0, -92.0], [44.0, -82.0]]
+
+# What a browser accepts for the /data bodies
+ACCEPT_ENCODING = 'br, gzip'
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if platform.system() == 'Darwin' else rss / 1024
+
+
+def memory_mb():
+    """Return ``(rss, private)`` of this process in MB, private being None off Linux.
+
+    Private memory is what a forked worker no longer shares with its parent.
+    """
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = dict(re.findall(r'^(\w+):\s+(\d+) kB', f.read(), re.M))
+    except OSError:
+        return peak_rss_mb(), None
+    private = int(fields['Private_Clean']) + int(fields['Private_Dirty'])
+    return int(fields['Rss']) / 1024, private / 1024
+
+
+def layout_values(layout):
+    """Map ``(id, property)`` to the value set in the layout, as the browser starts."""
+    if callable(layout):
+        layout = layout()
+    values = {}
+    for component in layout._traverse():
+        component_id = getattr(component, 'id', None)
+        if component_id is None:
+            continue
+        key = json.dumps(component_id, sort_keys=True) if isinstance(component_id, dict) else component_id
+        for prop in component._prop_names:
+            values[(key, prop)] = getattr(component, prop, None)
+    return values
+
+
+def matches(pattern, component_id):
+    # Pattern-matching ids: ALL matches any value, other keys must be equal
+    if set(pattern) != set(component_id):
+        return False
+    return all(v == ['ALL'] or v == component_id[k] for k, v in pattern.items())
+
+
+def callback_body(app, output, values, changed):
+    """Build the request the Dash renderer sends for one callback."""
+    spec = app.callback_map[output]
+    pattern_ids = [json.loads(key) for key in dict.fromkeys(key for key, _ in values) if key.startswith('{')]
+
+    def resolve(dependencies):
+        resolved = []
+        for dep in dependencies:
+            if dep['id'].startswith('{'):
+                pattern = json.loads(dep['id'])
+                resolved.append([
+                    {'id': component_id, 'property': dep['property'],
+                     'value': values.get((json.dumps(component_id, sort_keys=True), dep['property']))}
+                    for component_id in pattern_ids if matches(pattern, component_id)
+                ])
+            else:
+                resolved.append({'id': dep['id'], 'property': dep['property'],
+                                 'value': values.get((dep['id'], dep['property']))})
+        return resolved
+
+    outputs = [{'id': o.split('.')[0], 'property': o.split('.')[1]} for o in output.strip('.').split('...')]
+    return {
+        'output': output,
+        'outputs': outputs,
+        'inputs': resolve(spec['inputs']),
+        'state': resolve(spec.get('state', [])),
+        'changedPropIds': changed
+    }
+
+
+def output_key(app, output_id):
+    """Return the callback_map key of the callback writing ``output_id``."""
+    for key in app.callback_map:
+        if f'..{output_id}...' in key or key == output_id:
+            return key
+    raise ValueError(f'No callback outputs {output_id}')
+
+
+def scenarios(app, levels, n_values):
+    """Yield ``(name, body)`` for every level, N and view of the map and table."""
+    values = layout_values(app.layout)
+    map_output = output_key(app, 'geojson.data')
+    table_output = output_key(app, 'ranking-table.data')
+    views = {
+        'map': {('map', 'bounds'): NATIONAL, ('map', 'zoom'): 3, ('cluster-levels', 'value'): []},
+        'map-regional': {('map', 'bounds'): REGIONAL, ('map', 'zoom'): 6, ('cluster-levels', 'value'): []},
+        'map-clustered': {('map', 'bounds'): NATIONAL, ('map', 'zoom'): 3},
+        'table': {('table-scope', 'value'): 'mapped'}
+    }
+    for level in levels:
+        for n in n_values:
+            for view, overrides in views.items():
+                state = dict(values)
+                state.update(overrides)
+                state[('data-type', 'value')] = level
+                state[('n-dropdown', 'value')] = n
+                if view == 'map-clustered':
+                    state[('cluster-levels', 'value')] = [level]
+                output = table_output if view == 'table' else map_output
+                yield f'{view}/{level}/{n}', callback_body(app, output, state, ['data-type.value'])
+
+
+def summarize(name, latencies, sizes, rss):
+    latencies = np.asarray(latencies) * 1000
+    view, level, n = name.split('/')
+    row = {'scenario': name, 'view': view, 'level': level, 'n': n, 'requests': len(latencies)}
+    for p, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        row[f'p{p}_ms'] = round(float(value), 3)
+    row['bytes'] = int(np.median(sizes))
+    row['peak_rss_mb'] = round(rss, 1)
+    return row
+
+
+def data_url(data):
+    """Return the ``/data`` URL a map response points the GeoJSON layer at, if any."""
+    geojson = json.loads(data).get('response', {}).get('geojson', {})
+    return geojson.get('url')
+
+
+def process_rss_mb(pid):
+    """Peak RSS of another process on this host in MB, None when it cannot be read."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_local(bodies, repeat, warmup):
+    """Time each scenario in-process through the Flask test client.
+
+    A map response that points at a ``/data`` URL is followed, as the
+    browser does on a cold cache, and the fetch counts towards the
+    scenario's latency and bytes.
+    """
+    import app as dashboard
+
+    client = dashboard.server.test_client()
+
+    def request(body):
+        response = client.post('/_dash-update-component', json=body)
+        if response.status_code != 200:
+            return response, 0
+        url = data_url(response.data)
+        if url is None:
+            return response, 0
+        return client.get(url, headers={'Accept-Encoding': ACCEPT_ENCODING}), len(response.data)
+
+    rows = []
+    for name, body in bodies:
+        for _ in range(warmup):
+            request(body)
+        latencies, sizes = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response, callback_bytes = request(body)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError(f'{name} returned {response.status_code}: {response.data[:200]!r}')
+            sizes.append(callback_bytes + len(response.data))
+        rows.append(summarize(name, latencies, sizes, peak_rss_mb()))
+    return rows
+
+
+def run_remote(url, bodies, repeat, concurrency, pids=()):
+    """Send every scenario to a running server from ``concurrency`` threads.
+
+    Map responses are followed to their ``/data`` URL as in ``run_local``.
+    The server's memory is only known for the worker ``pids`` given,
+    which must run on this host; the peak RSS of the largest is reported.
+    """
+    base = url.rstrip('/')
+
+    def post(body):
+        request = urllib.request.Request(base + '/_dash-update-component', data=json.dumps(body).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        with urllib.request.urlopen(request) as response:
+            data = response.read()
+        size = len(data)
+        fetch = data_url(data)
+        if fetch is not None:
+            with urllib.request.urlopen(urllib.request.Request(base + fetch, headers={'Accept-Encoding': ACCEPT_ENCODING})) as response:
+                size += len(response.read())
+        return time.perf_counter() - start, size
+
+    def worker_rss():
+        values = [v for v in (process_rss_mb(pid) for pid in pids) if v is not None]
+        return max(values) if values else float('nan')
+
+    rows = []
+    with ThreadPoolExecutor(concurrency) as pool:
+        for name, body in bodies:
+            start = time.perf_counter()
+            results = list(pool.map(post, [body] * repeat))
+            elapsed = time.perf_counter() - start
+            row = summarize(name, [r[0] for r in results], [r[1] for r in results], worker_rss())
+            row['requests_per_s'] = round(repeat / elapsed, 1)
+            rows.append(row)
+    return rows
+
+
+def run(args):
+    start = time.perf_counter()
+    import app as dashboard
+    startup_s = time.perf_counter() - start
+
+    levels = args.levels or [option['value'] for option in dashboard.level_options]
+    n_values = [int(n) if n != 'all' else n for n in (args.n or [*dashboard.N_VALUES, 'all'])]
+    bodies = list(scenarios(dashboard.app, levels, n_values))
+    if args.url:
+        rows = run_remote(args.url, bodies, args.repeat, args.concurrency, args.pid or ())
+    else:
+        rows = run_local(bodies, args.repeat, args.warmup)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'target': args.url or 'test-client',
+        'startup_s': round(startup_s, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'results': rows
+    }
+    if args.url:
+        # This process only builds the requests, the server's memory is the workers'
+        report['worker_rss_mb'] = {pid: process_rss_mb(pid) for pid in args.pid or ()}
+        report['peak_rss_mb'] = max((v for v in report['worker_rss_mb'].values() if v is not None), default=None)
+    print(pd.DataFrame(rows).set_index('scenario').to_string())
+    if args.url and report['peak_rss_mb'] is None:
+        print('\nServer RSS not measured, pass the worker PIDs with --pid (e.g. from pgrep -f app:server)')
+    elif args.url:
+        print('\nPeak RSS per worker: ' + ', '.join(f'{pid}: {rss:.1f} MB' for pid, rss in report['worker_rss_mb'].items() if rss is not None))
+    else:
+        print(f"\nStartup {report['startup_s']}s, peak RSS {report['peak_rss_mb']} MB")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def probe(args):
+    """Preload the app, fork a worker, serve one map and table request per level and report memory."""
+    start = time.perf_counter()
+    import app as dashboard
+    import_s = time.perf_counter() - start
+    master_rss, _ = memory_mb()
+    gc.freeze()
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        client = dashboard.server.test_client()
+        levels = [option['value'] for option in dashboard.level_options]
+        for name, body in scenarios(dashboard.app, levels, [*dashboard.N_VALUES, 'all']):
+            client.post('/_dash-update-component', json=body)
+        worker_rss, worker_private = memory_mb()
+        with os.fdopen(write, 'w') as f:
+            json.dump({'worker_rss_mb': worker_rss, 'worker_private_mb': worker_private}, f)
+        os._exit(0)
+
+    os.close(write)
+    with os.fdopen(read) as f:
+        worker = json.load(f)
+    os.waitpid(pid, 0)
+    print(json.dumps({'import_s': import_s, 'master_rss_mb': master_rss, **worker}))
+
+
+def startup(args):
+    """Measure a cold start in a fresh interpreter and fail when it exceeds the budget."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__), 'probe'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        return result.returncode
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+
+    # -X importtime lines: "import time: self [us] | cumulative | imported package", indented per nesting level;
+    # keep the top-level imports and what they import directly
+    imports = re.findall(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', result.stderr, re.M)
+    top = pd.DataFrame([(name, int(cumulative) / 1e6) for _, cumulative, indent, name in imports if len(indent) <= 3],
+                       columns=['module', 'cumulative_s'])
+    print(top.nlargest(args.top, 'cumulative_s').to_string(index=False))
+    print()
+
+    budget = {
+        'import_s': args.max_import_s,
+        'master_rss_mb': args.max_rss_mb,
+        'worker_private_mb': args.max_worker_private_mb
+    }
+    over = []
+    for key, value in report.items():
+        limit = budget.get(key)
+        if value is None:
+            print(f'{key}: not available on this platform')
+            continue
+        print(f'{key}: {value:.2f}' + (f' (budget {limit})' if limit is not None else ''))
+        if limit is not None and value > limit:
+            over.append(key)
+    if over:
+        print(f'\nOver budget: {", ".join(over)}')
+        return 1
+    return 0
+
+
+def compare(args):
+    """Print the change per scenario and fail when a metric regressed past the threshold."""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    before = pd.DataFrame(baseline['results']).set_index('scenario')
+    after = pd.DataFrame(candidate['results']).set_index('scenario')
+    metrics = [m for m in (*[f'p{p}_ms' for p in PERCENTILES], 'bytes') if m in before and m in after]
+    common = before.index.intersection(after.index)
+
+    report = pd.DataFrame(index=common)
+    regressed = pd.Series(False, index=common)
+    for metric in metrics:
+        change = (after.loc[common, metric] - before.loc[common, metric]) / before.loc[common, metric]
+        report[metric] = after.loc[common, metric]
+        report[f'{metric} change'] = (change * 100).round(1).astype(str) + '%'
+        if metric in args.gate:
+            regressed |= change > args.threshold
+    report['regressed'] = regressed
+    print(report.to_string())
+
+    for key in ('startup_s', 'peak_rss_mb'):
+        print(f'{key}: {baseline.get(key)} -> {candidate.get(key)}')
+    missing = before.index.difference(after.index)
+    if len(missing):
+        print(f'{len(missing)} scenario(s) of the baseline missing from the candidate')
+    if regressed.any():
+        print(f'\n{regressed.sum()} scenario(s) regressed by more than {args.threshold:.0%}')
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='benchmark the callbacks')
+    run_parser.add_argument('--levels', nargs='+', help='aggregation levels, all by default')
+    run_parser.add_argument('--n', nargs='+', help="N values, e.g. 20 500 all; all dropdown values by default")
+    run_parser.add_argument('--repeat', type=int, default=50, help='timed requests per scenario')
+    run_parser.add_argument('--warmup', type=int, default=3, help='untimed requests per scenario')
+    run_parser.add_argument('--url', help='benchmark a running server instead of the test client')
+    run_parser.add_argument('--concurrency', type=int, default=8, help='client threads with --url')
+    run_parser.add_argument('--pid', type=int, action='append',
+                            help='with --url, a worker process on this host to report the RSS of (repeatable)')
+    run_parser.add_argument('--output', help='write the results as JSON')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser('compare', help='compare two benchmark runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative increase')
+    compare_parser.add_argument('--gate', nargs='+', default=['p95_ms', 'bytes'], help='metrics that fail the comparison')
+    compare_parser.set_defaults(func=compare)
+
+    startup_parser = commands.add_parser('startup', help='check cold start time and memory against a budget')
+    startup_parser.add_argument('--max-import-s', type=float, default=10.0, help='seconds to import the app')
+    startup_parser.add_argument('--max-rss-mb', type=float, default=400.0, help='RSS of the master after preloading')
+    startup_parser.add_argument('--max-worker-private-mb', type=float, default=150.0,
+                                help='memory a worker stops sharing with the master after serving every level')
+    startup_parser.add_argument('--top', type=int, default=10, help='slowest imports to list')
+    startup_parser.set_defaults(func=startup)
+
+    # Run by ``startup`` in a fresh interpreter
+    probe_parser = commands.add_parser('probe')
+    probe_parser.set_defaults(func=probe)
+
+    args = parser.parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
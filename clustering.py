@@ -0,0 +1,140 @@
+"""Server-side hierarchical clustering of map locations.
+
+Points are projected to Web Mercator and bucketed into square cells whose
+size on screen is the same at every zoom level. A cell at zoom ``z`` is
+exactly four cells at zoom ``z + 1``, so each level is aggregated from the
+one below and the clusters nest the way supercluster's do. Every cluster
+keeps the mean rank of its leaves, which is what ``cluster_to_layer``
+used to compute client side with ``getLeaves``, and the zoom at which it
+splits up, which supercluster's ``getClusterExpansionZoom`` gave the
+click handler.
+"""
+import numpy as np
+
+
+# Cells are 256 / 2 ** CELL_BITS = 64 screen pixels wide at every zoom
+CELL_BITS = 2
+
+# Above this zoom locations are drawn individually
+MAX_CLUSTER_ZOOM = 12
+
+
+def mercator(lat, lon):
+    """Project lat/lon in degrees onto the unit Web Mercator square."""
+    x = np.asarray(lon, dtype='float64') / 360 + 0.5
+    sin = np.sin(np.radians(np.clip(lat, -85.05, 85.05)))
+    y = 0.5 - 0.25 * np.log((1 + sin) / (1 - sin)) / np.pi
+    return np.clip(x, 0, 1 - 1e-12), np.clip(y, 0, 1 - 1e-12)
+
+
+def abbreviate(count):
+    """Format a point count the way supercluster's point_count_abbreviated does."""
+    if count >= 10000:
+        return f'{round(count / 1000)}k'
+    if count >= 1000:
+        return f'{round(count / 100) / 10:g}k'
+    return str(count)
+
+
+class ClusterLevel:
+    """Clusters of one zoom level as parallel arrays."""
+
+    def __init__(self, cx, cy, count, rank_sum, lat_sum, lon_sum, first, expansion_zoom=None):
+        self.cx = cx
+        self.cy = cy
+        self.count = count
+        self.rank_sum = rank_sum
+        self.lat_sum = lat_sum
+        self.lon_sum = lon_sum
+        self.first = first  # position of the best ranked leaf
+        self.expansion_zoom = expansion_zoom  # first zoom showing more than this cluster
+
+    def __len__(self):
+        return len(self.count)
+
+    @property
+    def rank_mean(self):
+        return self.rank_sum / self.count
+
+    @property
+    def lat(self):
+        return self.lat_sum / self.count
+
+    @property
+    def lon(self):
+        return self.lon_sum / self.count
+
+    def subset(self, positions):
+        return ClusterLevel(self.cx[positions], self.cy[positions], self.count[positions],
+                            self.rank_sum[positions], self.lat_sum[positions],
+                            self.lon_sum[positions], self.first[positions],
+                            None if self.expansion_zoom is None else self.expansion_zoom[positions])
+
+    def merge(self, cx, cy):
+        """Aggregate entries sharing the cell ``(cx, cy)`` into one cluster each.
+
+        Returns the clusters and the cluster of each entry.
+        """
+        keys = (cy << 32) | cx
+        cells, inverse = np.unique(keys, return_inverse=True)
+        first = np.full(len(cells), np.iinfo('int64').max)
+        np.minimum.at(first, inverse, self.first)
+        return ClusterLevel(
+            cells & 0xFFFFFFFF,
+            cells >> 32,
+            np.bincount(inverse, weights=self.count, minlength=len(cells)).astype('int64'),
+            np.bincount(inverse, weights=self.rank_sum, minlength=len(cells)),
+            np.bincount(inverse, weights=self.lat_sum, minlength=len(cells)),
+            np.bincount(inverse, weights=self.lon_sum, minlength=len(cells)),
+            first
+        ), inverse
+
+    def parent(self, zoom):
+        """Merge groups of four neighbouring cells into the next zoom out.
+
+        ``zoom`` is the zoom of this level: a cluster made of several of
+        its cells expands there, one made of a single cell where that
+        cell does.
+        """
+        parent, inverse = self.merge(self.cx >> 1, self.cy >> 1)
+        children = np.bincount(inverse, minlength=len(parent))
+        expansion_zoom = np.empty(len(parent), dtype='int64')
+        expansion_zoom[inverse] = self.expansion_zoom
+        parent.expansion_zoom = np.where(children > 1, zoom, expansion_zoom)
+        return parent
+
+
+class ClusterPyramid:
+    """Clusters for every zoom from 0 to ``max_zoom`` over rank-sorted points."""
+
+    def __init__(self, lat, lon, rank, max_zoom=MAX_CLUSTER_ZOOM):
+        self.max_zoom = max_zoom
+        lat = np.asarray(lat, dtype='float64')
+        lon = np.asarray(lon, dtype='float64')
+        x, y = mercator(lat, lon)
+        scale = 2 ** (max_zoom + CELL_BITS)
+        points = ClusterLevel(
+            (x * scale).astype('int64'),
+            (y * scale).astype('int64'),
+            np.ones(len(lat), dtype='int64'),
+            np.asarray(rank, dtype='float64'),
+            lat,
+            lon,
+            np.arange(len(lat))
+        )
+        # The finest level merges points sharing a cell, coarser levels merge clusters
+        self.levels = [None] * (max_zoom + 1)
+        level, _ = points.merge(points.cx, points.cy)
+        # Past max_zoom the locations are drawn one by one
+        level.expansion_zoom = np.full(len(level), max_zoom + 1)
+        for zoom in range(max_zoom, -1, -1):
+            self.levels[zoom] = level
+            if zoom:
+                level = level.parent(zoom)
+
+    def level(self, zoom):
+        """Return the clusters for a zoom, or None when points are drawn as-is."""
+        zoom = 0 if zoom is None else int(zoom)
+        if zoom > self.max_zoom:
+            return None
+        return self.levels[max(zoom, 0)]
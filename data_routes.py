@@ -0,0 +1,260 @@
+"""Cacheable HTTP endpoints for the map and table data.
+
+The pre-built payload and ranked rows of every (level, N) are served from
+``/data/<kind>/<level>/<n>/<etag>.<ext>`` where ``etag`` is the SHA-1 of
+the body. A URL never changes content, so responses carry a strong ETag
+and ``Cache-Control: immutable`` and browsers, CDNs and reverse proxies
+can keep them indefinitely. Bodies are compressed with gzip and brotli
+when a version is published (``write_bodies``) and only read by the
+workers. Bodies missing from the published files, or built from other
+data, are compressed when the worker warms up; never per request.
+
+Every worker builds the same bodies from the same data, so a URL handed
+out by one worker can be served by any other. While workers swap to a new
+version some of them still serve the previous one; a URL of another
+version is then answered from the bodies that version published, as long
+as it is kept in the artifact store.
+"""
+import base64
+from collections import namedtuple
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+from flask import Response, abort, request
+
+from artifact_store import write_atomic
+from data_store import LEVELS, CentresStore, store
+from payloads import N_VALUES, PayloadCache, payload_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+MIMETYPES = {
+    'map': 'application/octet-stream',
+    'table': 'application/json'
+}
+
+EXTENSIONS = {
+    'map': 'pbf',
+    'table': 'json'
+}
+
+# File suffix of each encoding of a published body
+SUFFIXES = {
+    'identity': '',
+    'gzip': '.gz',
+    'br': '.br'
+}
+
+# Index of the published bodies, next to them in the version directory
+BODIES_INDEX = 'bodies.json'
+
+# A body with its pre-compressed variants, keyed by content encoding
+Body = namedtuple('Body', ['etag', 'mimetype', 'encodings'])
+
+
+def compress(data, mimetype, etag):
+    """Return the ``Body`` of ``data``, compressed with the smallest settings."""
+    encodings = {'identity': data, 'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encodings['br'] = brotli.compress(data)
+    return Body(etag, mimetype, encodings)
+
+
+def accepted_encoding(body):
+    """Pick the smallest encoding the client accepts."""
+    accepted = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if encoding in body.encodings and accepted[encoding]:
+            return encoding
+    return 'identity'
+
+
+def body_name(kind, level, n):
+    return f'{kind}_{level}_{n}.{EXTENSIONS[kind]}'
+
+
+class DataRoutes:
+    """Compressed bodies of the (level, N) map payloads and tables.
+
+    ``directory`` holds the bodies published by ``write_bodies``, if any,
+    and ``artifacts`` is the ``ArtifactStore`` it belongs to, whose other
+    versions' bodies are served by etag.
+    """
+
+    def __init__(self, payloads=payload_cache, centres=store, directory=None, artifacts=None):
+        self.payloads = payloads
+        self.centres = centres
+        self.directory = directory
+        self.artifacts = artifacts
+        self._bodies = {}  # (kind, level, n) -> (source digest, Body)
+        self._indexes = {}  # directory -> body name -> {'source': digest, 'etag': etag, 'encodings': [...]}
+        self._lock = threading.Lock()
+
+    def _index(self, directory):
+        """The published bodies of a version directory; versions never change, so it is read once."""
+        index = self._indexes.get(directory)
+        if index is None:
+            try:
+                with open(os.path.join(directory, BODIES_INDEX)) as f:
+                    index = json.load(f)
+            except FileNotFoundError:
+                index = {}
+            self._indexes[directory] = index
+        return index
+
+    def _read(self, directory, name, entry, mimetype):
+        encodings = {}
+        for encoding in entry['encodings']:
+            with open(os.path.join(directory, name + SUFFIXES[encoding]), 'rb') as f:
+                encodings[encoding] = f.read()
+        return Body(entry['etag'], mimetype, encodings)
+
+    def _load(self, kind, level, n, digest):
+        """Read a published body, or return None when it is missing or stale."""
+        if self.directory is None:
+            return None
+        name = body_name(kind, level, n)
+        entry = self._index(self.directory).get(name)
+        if entry is None or entry['source'] != digest:
+            return None
+        return self._read(self.directory, name, entry, MIMETYPES[kind])
+
+    def _other_version(self, kind, level, n, etag):
+        """Read the body with ``etag`` from another version in the store, or return None."""
+        if self.artifacts is None or level not in LEVELS or n not in N_VALUES:
+            return None
+        name = body_name(kind, level, n)
+        for version in reversed(self.artifacts.versions()):
+            directory = self.artifacts.path(version)
+            if directory == self.directory:
+                continue
+            entry = self._index(directory).get(name)
+            if entry is not None and entry['etag'] == etag:
+                try:
+                    return self._read(directory, name, entry, MIMETYPES[kind])
+                except FileNotFoundError:  # pruned meanwhile
+                    return None
+        return None
+
+    def _body(self, kind, level, n):
+        if level not in LEVELS or n not in N_VALUES:
+            return None
+        digest, top = self.centres.versioned_top(level, n)
+        cached = self._bodies.get((kind, level, n))
+        if cached is None or cached[0] != digest:
+            with self._lock:
+                cached = self._bodies.get((kind, level, n))
+                if cached is None or cached[0] != digest:
+                    body = self._load(kind, level, n, digest)
+                    if body is None and kind == 'map':
+                        payload = self.payloads.get(level, n)
+                        body = compress(base64.b64decode(payload.geobuf), MIMETYPES[kind], payload.etag)
+                    elif body is None:
+                        data = top.to_json(orient='records').encode()
+                        body = compress(data, MIMETYPES[kind], hashlib.sha1(data).hexdigest())
+                    cached = (digest, body)
+                    self._bodies[(kind, level, n)] = cached
+        return cached[1]
+
+    def url(self, kind, level, n):
+        body = self._body(kind, level, n)
+        if body is None:
+            return None
+        return f'/data/{kind}/{level}/{n}/{body.etag}.{EXTENSIONS[kind]}'
+
+    def map_url(self, level, n, payload=None):
+        """Return the URL of the pre-built payload of the top ``n`` locations.
+
+        With ``payload`` the URL is only returned when it serves that
+        same payload, and None otherwise.
+        """
+        body = self._body('map', level, n)
+        if body is None or (payload is not None and payload.etag != body.etag):
+            return None
+        return self.url('map', level, n)
+
+    def table_url(self, level, n):
+        """Return the URL of the ranked rows of the top ``n`` locations."""
+        return self.url('table', level, n)
+
+    def warm(self):
+        for level in LEVELS:
+            for n in N_VALUES:
+                self._body('map', level, n)
+                self._body('table', level, n)
+
+    def write(self, directory):
+        """Write every body and its encodings into ``directory`` for workers to read.
+
+        Files are replaced rather than rewritten, as ``directory`` may hold
+        links to the files of the version it is based on.
+        """
+        self.warm()
+        index = {}
+        for (kind, level, n), (digest, body) in sorted(self._bodies.items()):
+            name = body_name(kind, level, n)
+            for encoding, data in body.encodings.items():
+                write_atomic(os.path.join(directory, name + SUFFIXES[encoding]), data)
+            index[name] = {'source': digest, 'etag': body.etag, 'encodings': sorted(body.encodings)}
+        write_atomic(os.path.join(directory, BODIES_INDEX), json.dumps(index, indent=2))
+
+    def index(self):
+        """URLs of every (level, N) map payload and table."""
+        return {
+            level: {n: {kind: self.url(kind, level, n) for kind in EXTENSIONS} for n in N_VALUES}
+            for level in LEVELS
+        }
+
+    def serve_index(self):
+        return Response(json.dumps(self.index()), mimetype='application/json', headers={'Cache-Control': 'no-cache'})
+
+    def serve(self, kind, level, n, etag, ext):
+        if EXTENSIONS[kind] != ext:
+            abort(404)
+        body = self._body(kind, level, n)
+        if body is not None and body.etag != etag:
+            # Handed out by a worker on another version, before or after this one
+            body = self._other_version(kind, level, n, etag)
+        if body is None:
+            abort(404)
+        headers = {'ETag': f'"{body.etag}"', 'Cache-Control': CACHE_CONTROL, 'Vary': 'Accept-Encoding'}
+        if body.etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+
+        encoding = accepted_encoding(body)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(body.encodings[encoding], mimetype=body.mimetype, headers=headers)
+
+    def register(self, server, current=None):
+        """Add the ``/data`` routes to the Flask server.
+
+        ``current`` returns the ``DataRoutes`` answering each request,
+        this one by default.
+        """
+        current = current or (lambda: self)
+        server.add_url_rule('/data/index.json', 'data_index', lambda: current().serve_index())
+        server.add_url_rule('/data/<any(map, table):kind>/<level>/<int:n>/<etag>.<ext>', 'data_body',
+                            lambda **kwargs: current().serve(**kwargs))
+
+
+def write_bodies(directory):
+    """Compress the bodies of the level artifacts in ``directory`` into it.
+
+    Run when a version is published, so workers serving it read the
+    bodies instead of compressing them.
+    """
+    centres = CentresStore(directory)
+    DataRoutes(PayloadCache(centres), centres).write(directory)
+
+
+data_routes = DataRoutes()
@@ -0,0 +1,193 @@
+"""In-memory store for the ranked centres of each aggregation level.
+
+Each level is loaded once per worker, sorted by rank with incomplete rows
+dropped, and kept until the file on disk changes. Levels are read from a
+memory-mapped Arrow artifact (``<level>_centres.arrow``) when one exists,
+so workers share its pages, and from ``<level>_centres.csv`` otherwise.
+Other per-level files, such as the metric sums behind the weighted
+scoring, are loaded the same way through a store with another ``name``.
+"""
+import hashlib
+import io
+import os
+import threading
+
+import pandas as pd
+
+from instrumentation import timed
+from spatial_index import GridIndex
+
+try:
+    import pyarrow as pa
+except ImportError:  # CSV only
+    pa = None
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LEVELS = ('census_tract', 'county', 'city', 'state')
+
+# Column holding the location name for each level
+LABEL_COLUMNS = {
+    'census_tract': 'census_tract',
+    'county': 'county_name',
+    'city': 'city',
+    'state': 'state'
+}
+
+
+def rank_sorted(df):
+    """Sort by rank and drop NaN rows.
+
+    Each step is skipped when it would not change anything, so columns
+    backed by a memory-mapped artifact are not copied.
+    """
+    if not df['rank'].is_monotonic_increasing:
+        df = df.sort_values('rank', kind='mergesort')
+    if df.isna().values.any():
+        df = df.dropna()
+    if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0:
+        df = df.reset_index(drop=True)
+    return df
+
+
+def load_csv(path):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw).hexdigest()
+    return digest, pd.read_csv(io.BytesIO(raw))
+
+
+def load_artifact(path):
+    """Memory-map an Arrow IPC file written by the transformation notebook.
+
+    Numeric columns without nulls are backed directly by the mapped pages,
+    so the OS shares them between every worker that maps the same file.
+    """
+    source = pa.memory_map(path, 'r')
+    digest = hashlib.sha1(memoryview(source.read_buffer())).hexdigest()
+    source.seek(0)
+    table = pa.ipc.open_file(source).read_all()
+    return digest, table.to_pandas(split_blocks=True)
+
+
+def write_artifact(df, path):
+    """Write a level frame as the Arrow artifact ``load_artifact`` maps.
+
+    The file is written next to ``path`` and renamed into place, so a
+    running app never maps a partially written artifact.
+    """
+    df = rank_sorted(df).astype({'rank': 'int32', 'lat': 'float64', 'lon': 'float64'})
+    if 'description' in df:
+        df['description'] = df['description'].astype('category')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    tmp = f'{path}.tmp'
+    with pa.OSFile(tmp, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, path)
+
+
+def load_centres(path, level=None):
+    """Read a centres file and return ``(content hash, frame)``.
+
+    The frame is sorted by rank with NaN rows removed.
+    """
+    with timed('read', level):
+        if path.endswith('.arrow'):
+            digest, df = load_artifact(path)
+        else:
+            digest, df = load_csv(path)
+    with timed('sort', level):
+        df = rank_sorted(df)
+    return digest, df
+
+
+class CentresStore:
+    """Caches one pre-sorted frame per level, reloading when its file changes.
+
+    A ``versioned`` store reads a published version, whose files never
+    change, so a loaded level is kept without checking its file. The
+    version may be pruned while a worker still serves it.
+    """
+
+    def __init__(self, directory=BASE_DIR, name='centres', versioned=False):
+        self.directory = directory
+        self.name = name
+        self.versioned = versioned
+        self._frames = {}  # level -> ((path, mtime_ns), content hash, frame)
+        self._indexes = {}  # level -> (content hash, GridIndex)
+        self._lock = threading.Lock()
+
+    def path(self, level):
+        """Return the Arrow artifact for a level, or its CSV when there is none."""
+        if level not in LEVELS:
+            raise ValueError(f'Unknown aggregation level: {level!r}')
+        if pa is not None:
+            artifact = os.path.join(self.directory, f'{level}_{self.name}.arrow')
+            if os.path.exists(artifact):
+                return artifact
+        return os.path.join(self.directory, f'{level}_{self.name}.csv')
+
+    def available(self, level):
+        if self.versioned and level in self._frames:
+            return True
+        return os.path.exists(self.path(level))
+
+    def _entry(self, level):
+        cached = self._frames.get(level)
+        if self.versioned and cached is not None:
+            return cached
+        path = self.path(level)
+        source = (path, os.stat(path).st_mtime_ns)
+        cached = self._frames.get(level)
+        if cached is None or cached[0] != source:
+            with self._lock:
+                cached = self._frames.get(level)
+                if cached is None or cached[0] != source:
+                    cached = (source, *load_centres(path, level))
+                    self._frames[level] = cached
+        return cached
+
+    def frame(self, level):
+        """Return the full ranked frame for a level.
+
+        The frame is shared between requests and must not be modified.
+        """
+        return self._entry(level)[2]
+
+    def versioned_frame(self, level):
+        """Return ``(content hash, frame)`` read from the same snapshot."""
+        _, digest, df = self._entry(level)
+        return digest, df
+
+    def top_n(self, level, n):
+        """Return the ``n`` best ranked locations as a view of the cached frame."""
+        return self.frame(level).iloc[:n]
+
+    def versioned_top(self, level, n):
+        """Return ``(content hash, top n frame)`` read from the same snapshot."""
+        digest, df = self.versioned_frame(level)
+        return digest, df.iloc[:n]
+
+    def indexed_frame(self, level):
+        """Return ``(content hash, frame, GridIndex)`` for a level.
+
+        The grid index is built once per loaded frame.
+        """
+        digest, df = self.versioned_frame(level)
+        cached = self._indexes.get(level)
+        if cached is None or cached[0] != digest:
+            cached = (digest, GridIndex(df['lat'].values, df['lon'].values))
+            self._indexes[level] = cached
+        return digest, df, cached[1]
+
+    def label_column(self, level):
+        return LABEL_COLUMNS[level]
+
+    def preload(self):
+        for level in LEVELS:
+            self.indexed_frame(level)
+
+
+store = CentresStore()
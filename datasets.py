@@ -0,0 +1,119 @@
+"""The ranking data the app serves, and its hot-swapping.
+
+A ``Dataset`` bundles everything derived from one set of level files:
+the centres store, the encoded map payloads, the data routes' compressed
+bodies and the weighted views. Callbacks read ``active.dataset`` once and
+use only that object, so a request is always answered from one version.
+
+When ``ARTIFACT_DIR`` points at an ``ArtifactStore`` the app serves its
+current version and a background thread polls for a newer one. A new
+version is verified against its manifest and fully loaded and warmed by
+that thread, then swapped in with a single assignment. Without
+``ARTIFACT_DIR`` the files next to the app are served, as before.
+
+Each worker polls on its own, so for up to a poll interval workers serve
+different versions. The data routes answer a URL of any version still in
+the store from its published bodies, and a worker keeps serving a loaded
+version even once ``prune`` has removed its files.
+"""
+import logging
+import os
+import threading
+
+from artifact_store import ArtifactStore
+from data_routes import DataRoutes, data_routes
+from data_store import CentresStore, store
+from payloads import PayloadCache, payload_cache
+from scoring import WeightedViews, weighted_views
+
+
+ARTIFACT_DIR = os.environ.get('ARTIFACT_DIR')
+POLL_SECONDS = float(os.environ.get('ARTIFACT_POLL_SECONDS', '30'))
+
+logger = logging.getLogger(__name__)
+
+
+class Dataset:
+    """One version of the level data and the caches built from it."""
+
+    def __init__(self, version, centres, payloads, routes, weights):
+        self.version = version
+        self.centres = centres
+        self.payloads = payloads
+        self.routes = routes
+        self.weights = weights
+
+    @classmethod
+    def load(cls, directory, version=None, artifacts=None):
+        """Create the stores and caches for the artifacts in ``directory``.
+
+        ``artifacts`` is the store ``directory`` was published to, whose
+        other versions' bodies are served by etag during a swap.
+        """
+        centres = CentresStore(directory, versioned=version is not None)
+        payloads = PayloadCache(centres)
+        return cls(version, centres, payloads, DataRoutes(payloads, centres, directory, artifacts),
+                   WeightedViews(CentresStore(directory, name='metrics', versioned=version is not None)))
+
+    def warm(self):
+        """Load every level and build every pre-computed payload."""
+        self.centres.preload()
+        self.payloads.warm()
+        self.routes.warm()
+        self.weights.preload()
+        return self
+
+
+class ActiveDataset:
+    """Holds the dataset being served and swaps in newer versions."""
+
+    def __init__(self, artifacts=None):
+        self.artifacts = artifacts
+        self.dataset = self._initial()
+        self._watcher = None
+
+    def _initial(self):
+        version = self.artifacts.current() if self.artifacts else None
+        if version is None:
+            # The files shipped with the app, through the module-level caches
+            return Dataset(None, store, payload_cache, data_routes, weighted_views)
+        self.artifacts.verify(version)
+        return Dataset.load(self.artifacts.path(version), version, self.artifacts)
+
+    def refresh(self):
+        """Load and swap in the current version if it changed; return whether it did."""
+        version = self.artifacts.current() if self.artifacts else None
+        if version is None or version == self.dataset.version:
+            return False
+        self.artifacts.verify(version)
+        dataset = Dataset.load(self.artifacts.path(version), version, self.artifacts).warm()
+        self.dataset = dataset
+        logger.info('Serving artifact version %s', version)
+        return True
+
+    def _watch(self, interval, stop):
+        while not stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the current version, retry on the next poll
+                logger.exception('Could not load artifact version %s', self.artifacts.current())
+
+    def watch(self, interval=POLL_SECONDS):
+        """Poll for new versions from a daemon thread of this process.
+
+        Threads do not survive a fork, so gunicorn workers call this after
+        forking (see gunicorn.conf.py).
+        """
+        if self.artifacts is None or (self._watcher and self._watcher[0] == os.getpid()):
+            return
+        self._watcher = (os.getpid(), threading.Event())
+        threading.Thread(target=self._watch, args=(interval, self._watcher[1]),
+                         name='artifact-watcher', daemon=True).start()
+
+    def stop(self):
+        if self._watcher:
+            self._watcher[1].set()
+
+
+active = ActiveDataset(ArtifactStore(ARTIFACT_DIR) if ARTIFACT_DIR else None)
@@ -0,0 +1,32 @@
+"""Gunicorn settings for the dashboard (``gunicorn app:server``, see Procfile).
+
+The app is imported once in the master (``preload_app``), so the level
+frames, grid indexes, cluster pyramids and encoded payloads are built a
+single time and shared copy-on-write with every forked worker, and the
+workers start without importing anything. The garbage collector is kept
+off while the app is built and everything it built is frozen before
+forking, so collections in the workers never write to the shared pages.
+
+Bind address and worker count come from gunicorn's usual ``PORT`` and
+``WEB_CONCURRENCY`` environment variables. With ``ARTIFACT_DIR`` set,
+every worker watches the artifact store for new versions (see datasets.py).
+"""
+import gc
+
+
+preload_app = True
+
+# Collecting during the import would only shuffle objects between generations
+gc.disable()
+
+
+def when_ready(server):
+    # The app is loaded and no worker is forked yet
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+    # Threads are not inherited, each worker polls for new artifact versions itself
+    from datasets import active
+    active.watch()
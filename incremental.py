@@ -0,0 +1,256 @@
+"""Incremental re-ranking of the aggregation levels.
+
+A full run of the Data Transformation notebook rebuilds every level from
+``one_tree_planted_ejst``. ``RankingState`` keeps the per-tract inputs and
+the per-level totals of such a run so that a partial update of the
+screening tool data only touches the tracts that changed, re-ranks the
+groups they belong to and rewrites the artifacts of levels whose ranks,
+descriptions or metric sums changed.
+"""
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from data_store import LABEL_COLUMNS, write_artifact
+
+
+# Percentile columns summed into each tract's score
+METRICS = [
+    'PM25', 'Diesel_Particulate',
+    'Asthma',
+    'Household_Income',
+    'Census_Population_Density_Percentile',
+    'Building_Loss_Rate',
+    'Agricultural_Loss_Rate',
+    'Traffic_Proximity'
+]
+
+# Metrics used to describe a location, as in the notebook
+DESCRIPTION_COLS = [m for m in METRICS if m != 'Census_Population_Density_Percentile']
+
+# Column of the tract frame each level is grouped by
+LEVEL_KEYS = {
+    'census_tract': 'Census_tract_ID',
+    'county': 'county_fips',
+    'city': 'city_id',
+    'state': 'State'
+}
+
+# Source columns kept per tract
+TRACT_COLUMNS = [
+    'Census_tract_ID', 'county_fips', 'County_Name', 'State', 'city_id',
+    'Total_population', 'geo_area',
+    *DESCRIPTION_COLS
+]
+
+TOTAL_COLUMNS = [*METRICS, 'summed_percentiles', 'population', 'area', 'tracts']
+
+
+def density_percentile(density):
+    """``percent_rank()`` over density descending, as the notebook computes it.
+
+    Spark sorts nulls last in a descending window, so missing densities
+    share the rank after the last known one.
+    """
+    values = np.asarray(density, dtype='float64')
+    n = len(values)
+    if n < 2:
+        return np.zeros(n)
+    known = ~np.isnan(values)
+    descending = np.sort(-values[known])
+    greater = np.searchsorted(descending, -values, side='left').astype('float64')
+    greater[~known] = known.sum()
+    return greater / (n - 1)
+
+
+def contributions(tracts):
+    """Return what each tract adds to the totals of the groups it belongs to."""
+    c = tracts[METRICS].astype('float64')
+    # A null percentile makes the whole sum null, which Spark's sum() then skips
+    c['summed_percentiles'] = c[METRICS].sum(axis=1, skipna=False)
+    c['population'] = tracts['Total_population']
+    c['area'] = tracts['geo_area']
+    c['tracts'] = 1
+    return c
+
+
+def group_totals(tracts, key):
+    # Tracts without a key (no city) are left out, as the notebook drops them
+    return contributions(tracts).groupby(tracts[key].values).sum()
+
+
+def describe(totals, k=3):
+    """Build 'Ranks highly in: ...' strings from a level's metric sums.
+
+    Mirrors the notebook: each summed metric is percent-ranked within the
+    level and the ``k`` highest are listed, ties going to the metric
+    listed first.
+    """
+    n = len(totals)
+    ranks = totals[DESCRIPTION_COLS].rank(method='min', na_option='top')
+    pct = ((ranks - 1) / max(n - 1, 1)).to_numpy()
+    order = np.argsort(-pct, axis=1, kind='stable')[:, :k]
+    top = np.take_along_axis(pct, order, axis=1)
+    names = np.array(DESCRIPTION_COLS)[order]
+
+    parts = [pd.Series(names[:, j]) + ': ' + pd.Series((top[:, j] * 100).astype(int)).astype(str) + '%'
+             for j in range(order.shape[1])]
+    description = parts[0]
+    for part in parts[1:]:
+        description = description + ', ' + part
+    return pd.Series(('Ranks highly in: ' + description).values, index=totals.index)
+
+
+class LevelState:
+    """Totals per group of one level, with groups kept sorted by score."""
+
+    def __init__(self, totals):
+        self.totals = totals.reindex(columns=TOTAL_COLUMNS, fill_value=0.0)
+        score = self.totals['summed_percentiles'].to_numpy()
+        order = np.argsort(-score, kind='stable')
+        self.keys = self.totals.index.to_numpy()[order]
+        self.sorted_scores = -score[order]  # ascending, best first
+
+    def __len__(self):
+        return len(self.keys)
+
+    def apply(self, delta):
+        """Add per-group ``delta`` totals and re-rank only those groups."""
+        affected = delta.index
+        existing = affected.intersection(self.totals.index)
+        added = affected.difference(self.totals.index)
+        delta = delta.reindex(columns=TOTAL_COLUMNS, fill_value=0.0)
+
+        self.totals.loc[existing] = self.totals.loc[existing] + delta.loc[existing]
+        if len(added):
+            self.totals = pd.concat([self.totals, delta.loc[added]])
+        emptied = self.totals.index[self.totals['tracts'] <= 0].intersection(affected)
+        self.totals = self.totals.drop(index=emptied)
+
+        # Take the affected groups out of the sorted order and insert them again
+        keep = ~pd.Index(self.keys).isin(affected)
+        keys, scores = self.keys[keep], self.sorted_scores[keep]
+        moved = affected.difference(emptied)
+        moved_scores = -self.totals.loc[moved, 'summed_percentiles'].to_numpy()
+        order = np.argsort(moved_scores, kind='stable')
+        moved_keys, moved_scores = moved.to_numpy()[order], moved_scores[order]
+        positions = np.searchsorted(scores, moved_scores, side='right')
+        self.keys = np.insert(keys, positions, moved_keys)
+        self.sorted_scores = np.insert(scores, positions, moved_scores)
+
+    def ranks(self, n=None):
+        """Return ``(keys, ranks)`` of the best ``n`` groups; equal scores share a rank."""
+        scores = self.sorted_scores[:n]
+        return self.keys[:n], np.searchsorted(self.sorted_scores, scores, side='left') + 1
+
+
+class RankingState:
+    """Per-tract inputs and per-level totals of the last ranking run."""
+
+    def __init__(self, tracts):
+        self.tracts = tracts
+        self.levels = {level: LevelState(group_totals(tracts, key)) for level, key in LEVEL_KEYS.items()}
+        self.published = {level: self._snapshot(level) for level in LEVEL_KEYS}
+
+    @classmethod
+    def from_tracts(cls, tracts):
+        """Build the state from the notebook's tract-level frame (one row per tract)."""
+        tracts = tracts[TRACT_COLUMNS].set_index('Census_tract_ID', drop=False)
+        tracts['Census_Population_Density_Percentile'] = density_percentile(tracts['Total_population'] / tracts['geo_area'])
+        return cls(tracts)
+
+    def _snapshot(self, level):
+        """Digest of what a level's artifacts are built from.
+
+        Covers the rank of every group and every group's totals, which
+        also decide the descriptions and the metrics artifact.
+        """
+        state = self.levels[level]
+        keys, ranks = state.ranks()
+        digest = hashlib.sha1(pd.util.hash_pandas_object(pd.Series(ranks, index=keys)).values)
+        digest.update(pd.util.hash_pandas_object(state.totals.sort_index()).values)
+        return digest.hexdigest()
+
+    def apply_updates(self, upserts=None, removed=()):
+        """Apply row-level changes and return the levels whose artifacts changed.
+
+        ``upserts`` holds new or replaced tracts with ``TRACT_COLUMNS``;
+        ``removed`` lists the ids of tracts that no longer exist.
+        """
+        before = self.tracts
+        after = before
+        if upserts is not None and len(upserts):
+            upserts = upserts[TRACT_COLUMNS].set_index('Census_tract_ID', drop=False)
+            after = pd.concat([after.drop(index=upserts.index, errors='ignore'), upserts])
+        if len(removed):
+            after = after.drop(index=list(removed), errors='ignore')
+        after = after.copy()
+        # Any density change shifts the percentile of every tract between its old and new value
+        after['Census_Population_Density_Percentile'] = density_percentile(after['Total_population'] / after['geo_area'])
+
+        common = before.index.intersection(after.index)
+        old, new = before.loc[common], after.loc[common]
+        differs = ~((old == new) | (old.isna() & new.isna())).all(axis=1)
+        changed = common[differs.to_numpy()]
+        old_rows = before.loc[changed.union(before.index.difference(after.index))]
+        new_rows = after.loc[changed.union(after.index.difference(before.index))]
+        self.tracts = after
+
+        for level, key in LEVEL_KEYS.items():
+            delta = group_totals(new_rows, key).sub(group_totals(old_rows, key), fill_value=0.0)
+            if len(delta):
+                self.levels[level].apply(delta)
+        return [level for level in LEVEL_KEYS if self._snapshot(level) != self.published[level]]
+
+    def sync(self, tracts):
+        """Diff a freshly loaded tract frame against the state and apply the changes."""
+        tracts = tracts[TRACT_COLUMNS].set_index('Census_tract_ID', drop=False)
+        current = self.tracts[TRACT_COLUMNS]
+        common = tracts.index.intersection(current.index)
+        old, new = current.loc[common], tracts.loc[common]
+        differs = ~((old == new) | (old.isna() & new.isna())).all(axis=1)
+        upserts = pd.concat([new[differs.to_numpy()], tracts.loc[tracts.index.difference(current.index)]])
+        removed = current.index.difference(tracts.index)
+        return self.apply_updates(upserts, removed)
+
+    def level_frame(self, level, centres, metrics=False):
+        """Return the ranked centres frame of a level.
+
+        ``centres`` is indexed by the level key and holds the label column
+        the dashboard expects plus ``lat`` and ``lon``. With ``metrics``
+        the per-group metric sums used for weighted scoring are included.
+        """
+        state = self.levels[level]
+        keys, ranks = state.ranks()
+        frame = pd.DataFrame({'rank': ranks}, index=pd.Index(keys))
+        frame['description'] = describe(state.totals).reindex(frame.index)
+        frame = frame.join(centres[[LABEL_COLUMNS[level], 'lat', 'lon']])
+        columns = [LABEL_COLUMNS[level], 'rank', 'lat', 'lon', 'description']
+        if metrics:
+            frame = frame.join(state.totals[METRICS].fillna(0.0))
+            columns += METRICS
+        return frame[columns].reset_index(drop=True)
+
+    def write_metrics(self, levels, centres, directory):
+        """Write the ``<level>_metrics`` artifacts read by the weighted scoring."""
+        for level in levels:
+            write_artifact(self.level_frame(level, centres[level], metrics=True), os.path.join(directory, f'{level}_metrics.arrow'))
+
+    def write_artifacts(self, levels, centres, directory):
+        """Write the artifacts of ``levels`` and mark them as published."""
+        for level in levels:
+            write_artifact(self.level_frame(level, centres[level]), os.path.join(directory, f'{level}_centres.arrow'))
+            self.published[level] = self._snapshot(level)
+        self.write_metrics(levels, centres, directory)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
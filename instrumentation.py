@@ -0,0 +1,304 @@
+"""Opt-in timing, size and cache metrics for the dashboard's hot path.
+
+Set ``DASH_METRICS=1`` to record, per aggregation level, how long each
+stage of a map or table update takes (reading and sorting a level file,
+building tooltips, ``dicts_to_geojson``, ``geojson_to_geobuf``, the
+callback body and the Dash response serialization), the size of the
+responses and the payload cache hits and misses. The histograms are
+exposed in the Prometheus text format on ``/metrics``.
+
+``DASH_METRICS_MEMORY=1`` also records the memory each stage allocates,
+as the tracemalloc peak during the stage above what was allocated when
+it started. tracemalloc slows every allocation down, so this is off by
+default and the timings are inflated while it is on. The peak is per
+process: allocations by other threads, such as the artifact watcher
+loading a new version, count towards the stage that is running.
+
+The numbers are kept per process, so behind gunicorn a scrape of
+``/metrics`` reads whichever worker answers. Set ``DASH_METRICS_DIR`` to
+a directory shared by the workers (like ``DASH_PROFILE_DIR``) and each
+worker writes its numbers there at most every ``DUMP_SECONDS``; the
+route then adds up the files of every worker, so the last second of
+another worker's requests may be missing. Files of workers that exited
+are kept, which keeps the totals cumulative.
+
+``DASH_PROFILE_RATE`` (a fraction such as ``0.01``) additionally runs
+that share of the callbacks under cProfile and writes one ``.prof``
+dump per profiled call to ``DASH_PROFILE_DIR``.
+
+When disabled, ``timed`` and ``count`` return immediately.
+"""
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+from flask import Response, g
+
+
+ENABLED = os.environ.get('DASH_METRICS', '0') not in ('', '0', 'false')
+MEMORY = ENABLED and os.environ.get('DASH_METRICS_MEMORY', '0') not in ('', '0', 'false')
+PROFILE_RATE = float(os.environ.get('DASH_PROFILE_RATE', '0'))
+PROFILE_DIR = os.environ.get('DASH_PROFILE_DIR', 'profiles')
+METRICS_DIR = os.environ.get('DASH_METRICS_DIR')
+DUMP_SECONDS = 1.0
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = tuple(256 * 4 ** i for i in range(10))  # 256 B to 64 MB
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per label set."""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts, sum, count]
+
+    def empty(self):
+        return Histogram(self.name, self.help, self.buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def snapshot(self):
+        return [[list(labels), series] for labels, series in self._series.items()]
+
+    def merge(self, snapshot):
+        for labels, (counts, total, count) in snapshot:
+            key = tuple(tuple(label) for label in labels)
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            series[0] = [a + b for a, b in zip(series[0], counts)]
+            series[1] += total
+            series[2] += count
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            for bound, bucket in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{format_labels(labels + (("le", bound),))} {bucket}')
+            lines.append(f'{self.name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {count}')
+        return lines
+
+
+class Counter:
+    """Monotonic counter with one series per label set."""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._series = {}  # labels -> count
+
+    def empty(self):
+        return Counter(self.name, self.help)
+
+    def inc(self, **labels):
+        key = tuple(sorted(labels.items()))
+        self._series[key] = self._series.get(key, 0) + 1
+
+    def snapshot(self):
+        return [[list(labels), count] for labels, count in self._series.items()]
+
+    def merge(self, snapshot):
+        for labels, count in snapshot:
+            key = tuple(tuple(label) for label in labels)
+            self._series[key] = self._series.get(key, 0) + count
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labels, count in sorted(self._series.items()):
+            lines.append(f'{self.name}{format_labels(labels)} {count}')
+        return lines
+
+
+lock = threading.Lock()
+
+stage_seconds = Histogram('dashboard_stage_seconds', 'Time spent in each stage of a map or table update.', SECONDS_BUCKETS)
+response_bytes = Histogram('dashboard_response_bytes', 'Size of the callback responses.', BYTES_BUCKETS)
+cache_requests = Counter('dashboard_cache_requests_total', 'Payload cache lookups by result.')
+stage_memory = Histogram('dashboard_stage_memory_bytes', 'Peak memory allocated in each stage of a map or table update.', BYTES_BUCKETS)
+
+METRICS = (stage_seconds, response_bytes, cache_requests, stage_memory)
+
+if MEMORY:
+    tracemalloc.start()
+
+# Stages running in this thread, innermost last, as [allocated at start, highest peak seen]
+memory_stages = threading.local()
+
+
+@contextmanager
+def measured(stage, level):
+    """Record the peak memory allocated in the block as ``stage`` of ``level``.
+
+    Nested stages reset the tracemalloc peak, so each stage keeps the
+    highest peak seen before and inside its nested stages.
+    """
+    if not MEMORY:
+        yield
+        return
+    stack = memory_stages.__dict__.setdefault('stack', [])
+    allocated, peak = tracemalloc.get_traced_memory()
+    if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+    tracemalloc.reset_peak()
+    frame = [allocated, allocated]
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        peak = max(tracemalloc.get_traced_memory()[1], frame[1])
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        with lock:
+            stage_memory.observe(peak - frame[0], stage=stage, level=level or 'none')
+
+
+@contextmanager
+def timed(stage, level=None):
+    """Record the time spent in the block as ``stage`` of ``level``."""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        with measured(stage, level):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with lock:
+            stage_seconds.observe(elapsed, stage=stage, level=level or 'none')
+
+
+def count(cache, hit, level=None):
+    """Count a cache lookup."""
+    if ENABLED:
+        with lock:
+            cache_requests.inc(cache=cache, result='hit' if hit else 'miss', level=level or 'none')
+
+
+@contextmanager
+def callback(name, level):
+    """Time a callback body, and profile it for a sampled fraction of calls.
+
+    The rest of the request, mostly Dash serializing the response, is
+    recorded as the ``serialize`` stage once the response is built.
+    """
+    profile = PROFILE_RATE > 0 and random.random() < PROFILE_RATE
+    if not (ENABLED or profile):
+        yield
+        return
+    profiler = cProfile.Profile() if profile else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        with measured(name, level):
+            yield
+    finally:
+        if profiler:
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+        if ENABLED:
+            with lock:
+                stage_seconds.observe(elapsed, stage=name, level=level)
+            g.instrumented_callback = (name, level, elapsed)
+        if profiler:
+            # Written after the timing stopped, the dump is not part of the call
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, f'{name}-{level}-{time.time_ns()}.prof'))
+
+
+last_dump = 0.0
+
+
+def dump(force=False):
+    """Write this process's numbers to ``METRICS_DIR``, at most every ``DUMP_SECONDS``."""
+    global last_dump
+    now = time.monotonic()
+    if METRICS_DIR is None or (not force and now - last_dump < DUMP_SECONDS):
+        return
+    last_dump = now
+    with lock:
+        snapshot = [metric.snapshot() for metric in METRICS]
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def combined():
+    """Metrics summed over the files of every worker in ``METRICS_DIR``."""
+    dump(force=True)
+    metrics = tuple(metric.empty() for metric in METRICS)
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for metric, series in zip(metrics, snapshot):
+            metric.merge(series)
+    return metrics
+
+
+def render():
+    if METRICS_DIR is not None:
+        lines = [line for metric in combined() for line in metric.render()]
+    else:
+        with lock:
+            lines = [line for metric in METRICS for line in metric.render()]
+    return '\n'.join(lines) + '\n'
+
+
+def register(server):
+    """Add the ``/metrics`` route and the response hooks when metrics are enabled.
+
+    Without ``DASH_METRICS_DIR`` the route only shows the numbers of the
+    worker that answers it.
+    """
+    if not ENABLED:
+        return
+
+    @server.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @server.after_request
+    def record_response(response):
+        instrumented = g.pop('instrumented_callback', None)
+        if instrumented is not None and not response.direct_passthrough:
+            name, level, elapsed = instrumented
+            total = time.perf_counter() - g.request_start
+            with lock:
+                stage_seconds.observe(max(total - elapsed, 0.0), stage='serialize', level=level)
+                response_bytes.observe(response.calculate_content_length() or 0, callback=name, level=level)
+            dump()
+        return response
+
+    server.add_url_rule('/metrics', 'metrics', lambda: Response(render(), mimetype='text/plain; version=0.0.4'))
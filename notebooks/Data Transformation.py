@@ -9,10 +9,31 @@
 
 # COMMAND ----------
 
-from pyspark.sql.functions import col, sum, max, percent_rank, concat, lit, rank, collect_list, concat_ws
+import os
+import sys
+
+from pyspark.sql.functions import col, sum, max, percent_rank, rank
 from pyspark.sql.window import Window
 import pandas as pd
 
+# Shared stages live in the repository root
+sys.path.append(os.path.abspath('..'))
+from transformations import description_percentiles, top_descriptions, level_descriptions, compare_with_centres, with_county_fips
+from artifact_store import ArtifactStore
+from data_routes import write_bodies
+from data_store import write_artifact
+from incremental import LEVEL_KEYS, RankingState, TRACT_COLUMNS
+from precompute import centres_lookups
+from spatial_join import county_cities
+
+# 'full' rebuilds every level, 'incremental' only applies what changed since the last run
+dbutils.widgets.dropdown('mode', 'full', ['full', 'incremental'])
+mode = dbutils.widgets.get('mode')
+
+# Versioned artifacts the dashboard watches (its ARTIFACT_DIR)
+artifacts = ArtifactStore('/dbfs/FileStore/one_tree_planted/artifacts')
+state_path = '/dbfs/FileStore/one_tree_planted/ranking_state.pkl'
+
 # COMMAND ----------
 
 cols = ['State', 'County_Name', 'Census_tract_ID', 'Total_threshold_criteria_exceeded',
@@ -38,8 +59,7 @@ description_cols = [
 # COMMAND ----------
 
 census_tract_centres = spark.sql('select * from one_tree_planted_census_tract_centres')
-state_centres = spark.sql('select * from one_tree_planted_state_centres')
-county_centres = spark.sql('select * from one_tree_planted_county_centres')
+tract_centres_pd = census_tract_centres.select('GEOID10', 'lat', 'lon').toPandas()
 
 df = (spark.sql('select * from one_tree_planted_ejst'))
 
@@ -53,23 +73,20 @@ df = (df
        .withColumnRenamed('Expected_agricultural_loss_rate__Natural_Hazards_Risk_Index___percentile_', 'Agricultural_Loss_Rate')
        .withColumnRenamed('Traffic_proximity_and_volume__percentile_', 'Traffic_Proximity')
      )
+
+# Counties are keyed on their (state, county) FIPS code, county names repeat across states
+df = with_county_fips(df)
                            
 
 
 
-cities_df = (spark.sql('select * from one_tree_planted_cities_lookup')
-             .select('city', 'county_name', 'population', 'lat', 'lng', 'id')
-             .withColumnRenamed('lat', 'city_lat')
-             .withColumnRenamed('lng', 'city_lon')
-             .withColumnRenamed('id', 'city_id')
-             .withColumnRenamed('county_name', 'countyName')
-             .withColumn('countyName', concat(col('countyName'), lit(' County')))
-             .withColumn('pop_rank', rank().over(Window.partitionBy(col('countyName')).orderBy(col('population').desc())))
-             .filter(col('pop_rank') == 1)
-             .drop('population', 'pop_rank')
-            )
+# The most populous city of each county, cities placed in the county of their nearest tract centroid
+city_lookup = county_cities(spark.sql('select * from one_tree_planted_cities_lookup')
+                            .select('city', 'population', 'lat', 'lng', 'id').toPandas(), tract_centres_pd)
+cities_df = spark.createDataFrame(city_lookup)
 
-df = df.join(cities_df, on=cities_df.countyName == df.County_Name, how='left').drop('countyName')
+# One city per county, so the join keeps one row per tract
+df = df.join(cities_df, on='county_fips', how='left')
 
 census_pop_df = (df
                  .select('Census_tract_ID', 'Total_population', 'geo_area')
@@ -78,7 +95,7 @@ census_pop_df = (df
                 )
 
 county_pop_df = (df
-                .groupBy('County_Name').agg((sum('total_population') / max('cf_area')).alias('county_population_density'))
+                .groupBy('county_fips').agg((sum('total_population') / max('cf_area')).alias('county_population_density'))
                 )
 
 state_pop_df = (df
@@ -86,15 +103,15 @@ state_pop_df = (df
                 )
 
 city_pop_df = (df
-                .groupBy('city').agg((sum('total_population') / sum('geo_area')).alias('city_population_density'))
+                .groupBy('city_id').agg((sum('total_population') / sum('geo_area')).alias('city_population_density'))
                 )
 
 
 full_df = (df
           .join(census_pop_df, on='Census_tract_id', how='left')
-          .join(county_pop_df, on='County_Name', how='left')
+          .join(county_pop_df, on='county_fips', how='left')
           .join(state_pop_df, on='State', how='left')
-          .join(city_pop_df, on='city', how='left')
+          .join(city_pop_df, on='city_id', how='left')
          )
 
 full_df = (full_df
@@ -103,6 +120,34 @@ full_df = (full_df
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Incremental update
+# MAGIC 
+# MAGIC In `incremental` mode the tract rows are diffed against the state saved by the last run. Only changed tracts are applied to the per-level totals, only their groups are re-ranked, and artifacts are rewritten only for levels whose ranks, descriptions or metric sums changed. The full rebuild below is skipped.
+
+# COMMAND ----------
+
+tracts = df.select(*TRACT_COLUMNS).toPandas()
+
+# Label, lat and lon per level; county and state centres come from their tracts' centroids
+centres = centres_lookups(tracts, tract_centres_pd, city_lookup)
+county_centres = spark.createDataFrame(centres['county'].reset_index())
+state_centres = spark.createDataFrame(centres['state'].reset_index(drop=True))
+
+if mode == 'incremental':
+    ranking_state = RankingState.load(state_path)
+    changed_levels = ranking_state.sync(tracts)
+    if changed_levels:
+        # A new version with the unchanged levels carried over from the current one
+        with artifacts.new_version(base=artifacts.current(), source='notebook', mode='incremental') as version_dir:
+            ranking_state.write_artifacts(changed_levels, centres, version_dir)
+            write_bodies(version_dir)
+    ranking_state.save(state_path)
+    dbutils.notebook.exit(f'Updated levels: {changed_levels}')
+
+# COMMAND ----------
+
 display(full_df.select(cols).orderBy('Census_Population_Density_Percentile', ascending=False))
 
 # COMMAND ----------
@@ -125,139 +170,37 @@ display(full_df)
 
 # COMMAND ----------
 
-state_description_df = full_df.select('state', *description_cols).groupBy('state').agg(                     
-                     sum('PM25').alias('PM25'),
-                     sum('Diesel_Particulate').alias('Diesel_Particulate'),
-                     sum('Asthma').alias('Asthma'),
-                     sum('Household_Income').alias('Household_Income'),
-                     sum('Building_Loss_Rate').alias('Building_Loss_Rate'),
-                     sum('Agricultural_Loss_Rate').alias('Agricultural_Loss_Rate'),
-                     sum('Traffic_Proximity').alias('Traffic_Proximity')
-                                                                                      )
-
-state_description_df = (state_description_df
-                        .withColumn('PM25', percent_rank().over(Window.partitionBy().orderBy(state_description_df['PM25'])))
-                        .withColumn('Diesel_Particulate', percent_rank().over(Window.partitionBy().orderBy(state_description_df['Diesel_Particulate'])))
-                        .withColumn('Asthma', percent_rank().over(Window.partitionBy().orderBy(state_description_df['Asthma'])))
-                        .withColumn('Household_Income', percent_rank().over(Window.partitionBy().orderBy(state_description_df['Household_Income'])))
-                        .withColumn('Building_Loss_Rate', percent_rank().over(Window.partitionBy().orderBy(state_description_df['Building_Loss_Rate'])))
-                        .withColumn('Agricultural_Loss_Rate', percent_rank().over(Window.partitionBy().orderBy(state_description_df['Agricultural_Loss_Rate'])))
-                        .withColumn('Traffic_Proximity', percent_rank().over(Window.partitionBy().orderBy(state_description_df['Traffic_Proximity'])))
-                       )
-
-city_description_df = full_df.select('city', *description_cols).groupBy('city').agg(                     
-                     sum('PM25').alias('PM25'),
-                     sum('Diesel_Particulate').alias('Diesel_Particulate'),
-                     sum('Asthma').alias('Asthma'),
-                     sum('Household_Income').alias('Household_Income'),
-                     sum('Building_Loss_Rate').alias('Building_Loss_Rate'),
-                     sum('Agricultural_Loss_Rate').alias('Agricultural_Loss_Rate'),
-                     sum('Traffic_Proximity').alias('Traffic_Proximity')
-                                                                                      )
-
-city_description_df = (city_description_df
-                        .withColumn('PM25', percent_rank().over(Window.partitionBy().orderBy(city_description_df['PM25'])))
-                        .withColumn('Diesel_Particulate', percent_rank().over(Window.partitionBy().orderBy(city_description_df['Diesel_Particulate'])))
-                        .withColumn('Asthma', percent_rank().over(Window.partitionBy().orderBy(city_description_df['Asthma'])))
-                        .withColumn('Household_Income', percent_rank().over(Window.partitionBy().orderBy(city_description_df['Household_Income'])))
-                        .withColumn('Building_Loss_Rate', percent_rank().over(Window.partitionBy().orderBy(city_description_df['Building_Loss_Rate'])))
-                        .withColumn('Agricultural_Loss_Rate', percent_rank().over(Window.partitionBy().orderBy(city_description_df['Agricultural_Loss_Rate'])))
-                        .withColumn('Traffic_Proximity', percent_rank().over(Window.partitionBy().orderBy(city_description_df['Traffic_Proximity'])))
-                       )
-
-county_description_df = full_df.select('county_name', *description_cols).groupBy('county_name').agg(                     
-                     sum('PM25').alias('PM25'),
-                     sum('Diesel_Particulate').alias('Diesel_Particulate'),
-                     sum('Asthma').alias('Asthma'),
-                     sum('Household_Income').alias('Household_Income'),
-                     sum('Building_Loss_Rate').alias('Building_Loss_Rate'),
-                     sum('Agricultural_Loss_Rate').alias('Agricultural_Loss_Rate'),
-                     sum('Traffic_Proximity').alias('Traffic_Proximity')
-                                                                                      )
-
-county_description_df = (county_description_df
-                        .withColumn('PM25', percent_rank().over(Window.partitionBy().orderBy(county_description_df['PM25'])))
-                        .withColumn('Diesel_Particulate', percent_rank().over(Window.partitionBy().orderBy(county_description_df['Diesel_Particulate'])))
-                        .withColumn('Asthma', percent_rank().over(Window.partitionBy().orderBy(county_description_df['Asthma'])))
-                        .withColumn('Household_Income', percent_rank().over(Window.partitionBy().orderBy(county_description_df['Household_Income'])))
-                        .withColumn('Building_Loss_Rate', percent_rank().over(Window.partitionBy().orderBy(county_description_df['Building_Loss_Rate'])))
-                        .withColumn('Agricultural_Loss_Rate', percent_rank().over(Window.partitionBy().orderBy(county_description_df['Agricultural_Loss_Rate'])))
-                        .withColumn('Traffic_Proximity', percent_rank().over(Window.partitionBy().orderBy(county_description_df['Traffic_Proximity'])))
-                        )
+# Percentiles of the summed metrics for every level, computed in a single pass
+description_df = description_percentiles(full_df, metrics=description_cols)
 
-# COMMAND ----------
+# Top 3 metrics per location, kept in Spark with a windowed row_number
+descriptions = top_descriptions(description_df, k=3, metrics=description_cols)
 
-state_description_pandas = state_description_df.toPandas()
-
-state_description_pandas = (state_description_pandas
-                            .melt(id_vars=['state'])
-                            .groupby(['state'])
-                            .apply(lambda x: x.nlargest(3, columns=['value']))
-                           )
-
-state_description_nlargest = spark.createDataFrame(state_description_pandas)
-
-state_description_nlargest = (state_description_nlargest
-                              .withColumn('description', concat(col('variable'), lit(': '), (col('value') * 100).cast('int'),lit('%')))
-                              .groupby('state').agg(collect_list('description').alias('description'))
-                              .withColumn('description', concat(lit('Ranks highly in: '), concat_ws(', ', col('description'))))
-                             )
-display(state_description_nlargest)
+census_description_nlargest = level_descriptions(descriptions, 'census_tract')
+state_description_nlargest = level_descriptions(descriptions, 'state')
+city_description_nlargest = level_descriptions(descriptions, 'city')
+county_description_nlargest = level_descriptions(descriptions, 'county')
 
 # COMMAND ----------
 
-city_description_pandas = city_description_df.toPandas()
-
-city_description_pandas = (city_description_pandas
-                            .melt(id_vars=['city'])
-                            .groupby(['city'])
-                            .apply(lambda x: x.nlargest(3, columns=['value']))
-                           )
-
-city_description_nlargest = spark.createDataFrame(city_description_pandas)
-
-city_description_nlargest = (city_description_nlargest
-                              .withColumn('description', concat(col('variable'), lit(': '), (col('value') * 100).cast('int'),lit('%')))
-                              .groupby('city').agg(collect_list('description').alias('description'))
-                              .withColumn('description', concat(lit('Ranks highly in: '), concat_ws(', ', col('description'))))
-                             )
-display(city_description_nlargest)
-
-# COMMAND ----------
-
-county_description_pandas = county_description_df.toPandas()
-
-county_description_pandas = (county_description_pandas
-                            .melt(id_vars=['county_name'])
-                            .groupby(['county_name'])
-                            .apply(lambda x: x.nlargest(3, columns=['value']))
-                           )
-
-county_description_nlargest = spark.createDataFrame(county_description_pandas)
-
-county_description_nlargest = (county_description_nlargest
-                              .withColumn('description', concat(col('variable'), lit(': '), (col('value') * 100).cast('int'),lit('%')))
-                              .groupby('county_name').agg(collect_list('description').alias('description'))
-                              .withColumn('description', concat(lit('Ranks highly in: '), concat_ws(', ', col('description'))))
-                             )
-display(county_description_nlargest)
+display(state_description_nlargest)
 
 # COMMAND ----------
 
-city_ranks = full_df.groupBy('city_id').agg(sum('summed_percentiles').alias('rank')).orderBy('rank', ascending=False).limit(501)
-census_ranks = full_df.groupBy('census_tract_id').agg(sum('summed_percentiles').alias('rank')).orderBy('rank', ascending=False).limit(501)
-state_ranks = full_df.groupBy('state').agg(sum('summed_percentiles').alias('rank')).orderBy('rank', ascending=False).limit(501)
-county_ranks = full_df.groupBy('county_name').agg(sum('summed_percentiles').alias('rank')).orderBy('rank', ascending=False).limit(501)
+city_ranks = full_df.groupBy('city_id').agg(sum('summed_percentiles').alias('rank')).orderBy('rank', ascending=False)
+census_ranks = full_df.groupBy('census_tract_id').agg(sum('summed_percentiles').alias('rank')).orderBy('rank', ascending=False)
+state_ranks = full_df.groupBy('state').agg(sum('summed_percentiles').alias('rank')).orderBy('rank', ascending=False)
+county_ranks = full_df.groupBy('county_fips').agg(sum('summed_percentiles').alias('rank')).orderBy('rank', ascending=False)
 
 county_final = (county_ranks
-                .join(county_centres, on=county_ranks.county_name == county_centres.CF, how='left')
-                .join(county_description_nlargest, on='county_name', how='left')
+                .join(county_centres, on='county_fips', how='left')
+                .join(county_description_nlargest, on='county_fips', how='left')
                 .select('county_name', 'rank', 'lat', 'lon', 'description')
                 .withColumn('rank', rank().over(Window.partitionBy().orderBy(county_ranks['rank'].desc())))
                )
 
 state_final = (state_ranks
-                .join(state_centres, on=state_ranks.state == state_centres.SF, how='left')
+                .join(state_centres, on='state', how='left')
                 .join(state_description_nlargest, on='state', how='left')
                 .select('state', 'rank', 'lat', 'lon', 'description')
                 .withColumn('rank', rank().over(Window.partitionBy().orderBy(state_ranks['rank'].desc())))
@@ -265,7 +208,8 @@ state_final = (state_ranks
 
 census_final = (census_ranks
                 .join(census_tract_centres, on=census_ranks.census_tract_id == census_tract_centres.GEOID10, how='left')
-                .select('census_tract_id', 'rank', 'lat', 'lon')
+                .join(census_description_nlargest, on='census_tract_id', how='left')
+                .select('census_tract_id', 'rank', 'lat', 'lon', 'description')
                 .withColumn('rank', rank().over(Window.partitionBy().orderBy(census_ranks['rank'].desc())))
                )
 
@@ -273,7 +217,8 @@ census_final = (census_ranks
 
 city_final = (city_ranks
               .join(cities_df, on='city_id', how='left')
-              .join(city_description_nlargest, on='city', how='left')
+              # Names repeat across states (Springfield, Columbus), so cities are joined by id
+              .join(city_description_nlargest, on='city_id', how='left')
               .select('city', 'rank', 'city_lat', 'city_lon', 'description')
               .withColumnRenamed('city_lat', 'lat')
               .withColumnRenamed('city_lon', 'lon')
@@ -287,4 +232,38 @@ display(city_final)
 
 # COMMAND ----------
 
+# Regression check: the pipeline must reproduce the ranks and descriptions the dashboard ships.
+# Counties and cities are joined by FIPS code rather than by county name, so only states still match the shipped CSVs.
+for final_df, level, key in [(state_final, 'state', 'state')]:
+    mismatches = compare_with_centres(final_df, f'../{level}_centres.csv', key)
+    assert mismatches.empty, f'{level} differs from {level}_centres.csv:\n{mismatches}'
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Export
+# MAGIC 
+# MAGIC Each level is written as an uncompressed Arrow IPC file (`<level>_centres.arrow`) which the dashboard memory-maps, so every gunicorn worker shares the same pages. All levels go into a new checksummed version of the artifact store, which the dashboard swaps in once it is complete. Rows are written already sorted by rank with incomplete rows removed, `rank`/`lat`/`lon` are typed and `description` is dictionary encoded.
+# MAGIC 
+# MAGIC The per-group metric sums used by the dashboard's weighted scoring (`<level>_metrics.arrow`) and the state used by the incremental mode are saved alongside them.
+
+# COMMAND ----------
+
+def export_centres(final_df, level, version_dir):
+    write_artifact(final_df.toPandas(), f'{version_dir}/{level}_centres.arrow')
+
+ranking_state = RankingState.from_tracts(tracts)
+
+with artifacts.new_version(source='notebook', mode='full') as version_dir:
+    export_centres(census_final.withColumnRenamed('census_tract_id', 'census_tract'), 'census_tract', version_dir)
+    export_centres(county_final, 'county', version_dir)
+    export_centres(city_final, 'city', version_dir)
+    export_centres(state_final, 'state', version_dir)
+    # Per-group metric sums for the dashboard's weighted scoring
+    ranking_state.write_metrics(list(LEVEL_KEYS), centres, version_dir)
+    # Compressed map and table bodies, so the dashboard's workers don't compress them
+    write_bodies(version_dir)
 
+# State for incremental runs
+ranking_state.save(state_path)
@@ -0,0 +1,168 @@
+"""Memoized geobuf payloads for the map layer.
+
+There are only a handful of (level, N) combinations, so the encoded map
+data for each is built once and reused until the source file changes.
+"""
+from collections import namedtuple
+import hashlib
+import threading
+
+import dash_leaflet.express as dlx
+import numpy as np
+
+from clustering import ClusterPyramid, abbreviate
+from data_store import LEVELS, store
+from instrumentation import count, timed
+from spatial_index import in_bounds, max_features
+
+
+# Values offered in the "number of locations" dropdown, with pre-built payloads
+N_VALUES = (20, 50, 100, 200, 500)
+
+color_prop = 'rank'
+
+# etag is the SHA-1 of the encoded geobuf, digest the content hash of the source data
+MapPayload = namedtuple('MapPayload', ['geobuf', 'vmax', 'digest', 'etag'])
+
+
+def map_payload(geobuf, vmax, digest):
+    return MapPayload(geobuf, vmax, digest, hashlib.sha1(geobuf.encode()).hexdigest())
+
+
+def build_map_payload(df, label, digest=None, level=None):
+    """Encode a ranked frame as geobuf with a tooltip per location."""
+    with timed('tooltip', level):
+        df = df.copy()
+        tooltip = df[label].astype(str) + ' <br> '
+        if 'description' in df:
+            tooltip = tooltip + df['description'].astype(str)
+        df['tooltip'] = tooltip  # bind tooltip
+        dicts = df.to_dict('records')
+
+    with timed('dicts_to_geojson', level):
+        geojson = dlx.dicts_to_geojson(dicts)
+    with timed('geojson_to_geobuf', level):
+        geobuf = dlx.geojson_to_geobuf(geojson)
+    vmax = df[color_prop].max() if len(df) else 0
+    return map_payload(geobuf, vmax, digest)
+
+
+def build_cluster_payload(df, clusters, label, vmax, digest=None, level=None):
+    """Encode clusters as geobuf, drawing single-leaf clusters as their location."""
+    with timed('tooltip', level):
+        single = clusters.count == 1
+        leaves = df.iloc[clusters.first[single]].copy()
+        tooltip = leaves[label].astype(str) + ' <br> '
+        if 'description' in leaves:
+            tooltip = tooltip + leaves['description'].astype(str)
+        leaves['tooltip'] = tooltip  # bind tooltip
+
+        dicts = leaves.to_dict('records')
+        for points, rank_mean, lat, lon, expansion_zoom in zip(clusters.count[~single], clusters.rank_mean[~single],
+                                                               clusters.lat[~single], clusters.lon[~single],
+                                                               clusters.expansion_zoom[~single]):
+            dicts.append({
+                'lat': lat, 'lon': lon, color_prop: rank_mean,
+                'cluster': True, 'point_count': int(points), 'point_count_abbreviated': abbreviate(points),
+                'expansion_zoom': int(expansion_zoom),  # where a click on the cluster zooms to
+                'tooltip': '{} locations <br> Mean rank: {:.0f}'.format(points, rank_mean)
+            })
+
+    with timed('dicts_to_geojson', level):
+        geojson = dlx.dicts_to_geojson(dicts)
+    with timed('geojson_to_geobuf', level):
+        geobuf = dlx.geojson_to_geobuf(geojson)
+    return map_payload(geobuf, vmax, digest)
+
+
+class PayloadCache:
+    """Caches one payload per (level, N), keyed on the source file's hash."""
+
+    def __init__(self, centres=store):
+        self.centres = centres
+        self._payloads = {}  # (level, n) -> MapPayload
+        self._pyramids = {}  # (level, n) -> (content hash, ClusterPyramid)
+        self._lock = threading.Lock()
+
+    def get(self, level, n):
+        digest, top = self.centres.versioned_top(level, n)
+        payload = self._payloads.get((level, n))
+        hit = payload is not None and payload.digest == digest
+        count('payload', hit, level)
+        if not hit:
+            with self._lock:
+                payload = self._payloads.get((level, n))
+                if payload is None or payload.digest != digest:
+                    payload = build_map_payload(top, self.centres.label_column(level), digest, level)
+                    self._payloads[(level, n)] = payload
+        return payload
+
+    def viewport(self, level, n, bounds=None, zoom=None):
+        """Return the payload for the top ``n`` locations inside the map bounds.
+
+        ``n`` of None means every location of the level. The number of
+        features is capped by zoom level, keeping the best ranked ones.
+        When the viewport holds all of the top ``n`` the memoized payload is
+        returned, otherwise only the visible subset is encoded.
+        """
+        if bounds is None and n in N_VALUES:
+            return self.get(level, n)
+        if bounds is None:
+            bounds = [[-90, -180], [90, 180]]
+
+        if n is None:
+            # The whole level, so go through the grid index
+            (south, west), (north, east) = bounds
+            digest, top, index = self.centres.indexed_frame(level)
+            positions = index.query(south, west, north, east, limit=max_features(zoom))
+        else:
+            digest, top = self.centres.versioned_top(level, n)
+            positions = np.flatnonzero(in_bounds(top['lat'].values, top['lon'].values, bounds))[:max_features(zoom)]
+        if len(positions) == len(top) and n in N_VALUES:
+            return self.get(level, n)
+
+        payload = build_map_payload(top.iloc[positions], self.centres.label_column(level), digest, level)
+        # Keep the colour scale of the whole top n so colours don't shift while panning
+        vmax = top[color_prop].max() if len(top) else 0
+        return payload._replace(vmax=vmax)
+
+    def pyramid(self, level, n):
+        """Return ``(content hash, top n frame, ClusterPyramid)`` for a level."""
+        digest, top = self.centres.versioned_top(level, n)
+        cached = self._pyramids.get((level, n))
+        count('pyramid', cached is not None and cached[0] == digest, level)
+        if cached is None or cached[0] != digest:
+            with timed('cluster', level):
+                cached = (digest, ClusterPyramid(top['lat'].values, top['lon'].values, top[color_prop].values))
+            self._pyramids[(level, n)] = cached
+        return digest, top, cached[1]
+
+    def clusters(self, level, n, bounds=None, zoom=None):
+        """Return the pre-computed clusters of the top ``n`` locations for a zoom.
+
+        Only clusters whose centre is inside the bounds are sent, best
+        ranked first within the per-zoom feature budget. Past the last
+        clustered zoom the individual locations are returned.
+        """
+        digest, top, pyramid = self.pyramid(level, n)
+        clusters = pyramid.level(zoom)
+        if clusters is None:
+            return self.viewport(level, n, bounds, zoom)
+
+        if bounds is not None:
+            selected = np.flatnonzero(in_bounds(clusters.lat, clusters.lon, bounds))
+        else:
+            selected = np.arange(len(clusters))
+        selected = selected[np.argsort(clusters.first[selected], kind='stable')][:max_features(zoom)]
+
+        vmax = top[color_prop].max() if len(top) else 0
+        return build_cluster_payload(top, clusters.subset(selected), self.centres.label_column(level), vmax, digest, level)
+
+    def warm(self):
+        for level in LEVELS:
+            for n in N_VALUES:
+                self.get(level, n)
+                self.pyramid(level, n)
+
+
+payload_cache = PayloadCache()
@@ -0,0 +1,120 @@
+"""Batch job that publishes a new artifact version for the dashboard.
+
+Runs the ranking of the Data Transformation notebook outside Databricks,
+on exported EJST data and lookup tables, and writes every level's
+centres and metrics artifacts, with the compressed map and table bodies
+the app serves, as one checksummed version of an ``ArtifactStore``. An
+app started with ``ARTIFACT_DIR`` pointing at the same directory swaps
+the new version in without a restart.
+
+    python precompute.py --ejst ejst.csv --cities uscities.csv \\
+        --tract-centres census_tract_centres.csv --output artifacts [--engine spark] [--limit 5000]
+
+The inputs are CSV exports of the notebook's ``one_tree_planted_*``
+tables. Cities, counties and states are placed from the tract centroids
+by the joins of spatial_join.py. ``--engine pandas`` (the default) needs
+nothing beyond the app's requirements; ``--engine spark`` prepares the
+tract rows with a local Spark session as the notebook does. Either way
+the levels are then ranked by ``RankingState``.
+"""
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+from artifact_store import ArtifactStore
+from data_routes import write_bodies
+from data_store import write_artifact
+from incremental import LEVEL_KEYS, TRACT_COLUMNS, RankingState
+from spatial_join import county_cities, county_fips, level_centres
+
+
+# Screening tool columns renamed as in the notebook
+EJST_RENAMES = {
+    'PM2.5_in_the_air__percentile_': 'PM25',
+    'Diesel_particulate_matter_exposure__percentile_': 'Diesel_Particulate',
+    'Current_asthma_among_adults_aged_greater_than_or_equal_to_18_years__percentile_': 'Asthma',
+    'Low_median_household_income_as_a_percent_of_area_median_income__percentile_': 'Household_Income',
+    'Expected_building_loss_rate__Natural_Hazards_Risk_Index___percentile_': 'Building_Loss_Rate',
+    'Expected_agricultural_loss_rate__Natural_Hazards_Risk_Index___percentile_': 'Agricultural_Loss_Rate',
+    'Traffic_proximity_and_volume__percentile_': 'Traffic_Proximity'
+}
+
+
+def tract_frame(ejst, city_lookup):
+    """Return one row per tract with ``TRACT_COLUMNS``.
+
+    ``city_lookup`` holds one city per county (see ``county_cities``), so
+    the join never repeats a tract.
+    """
+    df = ejst.rename(columns=EJST_RENAMES)
+    df['county_fips'] = county_fips(df['Census_tract_ID'])
+    return df.merge(city_lookup, on='county_fips', how='left', validate='many_to_one')[TRACT_COLUMNS]
+
+
+def spark_tract_frame(paths, city_lookup, limit=None):
+    """Prepare the tract rows with a local Spark session and return them as pandas."""
+    from pyspark.sql import SparkSession
+    from transformations import with_county_fips
+
+    spark = SparkSession.builder.master('local[*]').appName('precompute').getOrCreate()
+    df = spark.read.csv(paths['ejst'], header=True, inferSchema=True)
+    if limit:
+        df = df.limit(limit)
+    for old, new in EJST_RENAMES.items():
+        df = df.withColumnRenamed(old, new)
+    df = with_county_fips(df).join(spark.createDataFrame(city_lookup), on='county_fips', how='left')
+    return df.select(*TRACT_COLUMNS).toPandas()
+
+
+def centres_lookups(tracts, tract_centres, city_lookup):
+    """Label, lat and lon per level, indexed by the key the level is ranked by."""
+    return {
+        'census_tract': tract_centres.assign(census_tract=tract_centres['GEOID10']).set_index('GEOID10')[['census_tract', 'lat', 'lon']],
+        'city': city_lookup.rename(columns={'city_lat': 'lat', 'city_lon': 'lon'}).set_index('city_id')[['city', 'lat', 'lon']],
+        **level_centres(tracts, tract_centres)
+    }
+
+
+def publish(artifacts, tracts, centres, **metadata):
+    """Rank every level and publish their artifacts as a new version; return its name."""
+    state = RankingState.from_tracts(tracts)
+    with artifacts.new_version(**metadata) as version_dir:
+        for level in LEVEL_KEYS:
+            write_artifact(state.level_frame(level, centres[level]), f'{version_dir}/{level}_centres.arrow')
+        state.write_metrics(list(LEVEL_KEYS), centres, version_dir)
+        write_bodies(version_dir)
+    return os.path.basename(version_dir).lstrip('.')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ejst', required=True, help='screening tool data, one row per census tract')
+    parser.add_argument('--cities', required=True, help='cities lookup with city, population, lat, lng, id')
+    parser.add_argument('--tract-centres', required=True, help='GEOID10, lat, lon per census tract')
+    parser.add_argument('--output', required=True, help='artifact store directory (the app\'s ARTIFACT_DIR)')
+    parser.add_argument('--engine', choices=['pandas', 'spark'], default='pandas')
+    parser.add_argument('--limit', type=int, help='only use the first LIMIT tracts, for a quick sample run')
+    parser.add_argument('--keep', type=int, default=3, help='number of versions to keep')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    tract_centres = pd.read_csv(args.tract_centres)
+    city_lookup = county_cities(pd.read_csv(args.cities), tract_centres)
+    if args.engine == 'spark':
+        tracts = spark_tract_frame({'ejst': args.ejst}, city_lookup, args.limit)
+    else:
+        ejst = pd.read_csv(args.ejst, nrows=args.limit)
+        tracts = tract_frame(ejst, city_lookup)
+    centres = centres_lookups(tracts, tract_centres, city_lookup)
+
+    version = publish(ArtifactStore(args.output, keep=args.keep), tracts, centres,
+                      source='precompute', engine=args.engine, rows=len(tracts))
+    print(f'Published {version} ({len(tracts)} tracts) in {time.perf_counter() - start:.1f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
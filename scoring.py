@@ -0,0 +1,196 @@
+"""User-weighted re-ranking of the aggregation levels.
+
+The notebook scores every location with equal weights on each metric.
+For custom weights the dashboard re-ranks a level from its per-group
+metric sums (``<level>_metrics.arrow`` or ``.csv``): the sums are held as
+a dense matrix, so a re-rank is one matrix-vector product followed by
+``argpartition`` for the top N. Views are memoized per quantized weight
+vector with LRU eviction, together with their encoded map payloads; the
+matrices are shared by all views.
+"""
+from functools import lru_cache
+import threading
+
+import numpy as np
+
+from data_store import BASE_DIR, LABEL_COLUMNS, LEVELS, CentresStore
+from incremental import METRICS
+from payloads import N_VALUES, PayloadCache
+from spatial_index import GridIndex
+
+
+# Weights are normalised to sum to one and rounded to this many decimals
+WEIGHT_DECIMALS = 2
+
+DEFAULT_WEIGHTS = tuple(1.0 for _ in METRICS)
+
+metrics_store = CentresStore(BASE_DIR, name='metrics')
+
+
+def quantize_weights(weights):
+    """Return a hashable, scale-free key for a weight vector.
+
+    All-zero or missing weights fall back to equal weights.
+    """
+    w = np.nan_to_num(np.asarray([0 if v is None else v for v in weights], dtype='float64'))
+    w = np.clip(w, 0, None)
+    if w.sum() == 0:
+        w = np.ones(len(METRICS))
+    return tuple(np.round(w / w.sum(), WEIGHT_DECIMALS))
+
+
+def is_default(key):
+    return key == quantize_weights(DEFAULT_WEIGHTS)
+
+
+def top_positions(scores, n):
+    """Positions of the ``n`` highest scores, best first.
+
+    Cut with ``argpartition`` so only the selected rows are sorted. Ties
+    at the cut go to the first rows, so the result is the start of a
+    stable sort of all scores.
+    """
+    k = min(n, len(scores))
+    if k == len(scores):
+        return np.argsort(-scores, kind='stable')
+    if k == 0:
+        return np.empty(0, dtype='int64')
+    threshold = -np.partition(-scores, k - 1)[k - 1]
+    better = np.flatnonzero(scores > threshold)
+    positions = np.concatenate([better, np.flatnonzero(scores == threshold)[:k - len(better)]])
+    return positions[np.argsort(-scores[positions], kind='stable')]
+
+
+class ReorderedIndex:
+    """A level's shared ``GridIndex`` answering in the rank order of one view."""
+
+    def __init__(self, index, order):
+        self.index = index
+        # Position in the view of each row of the shared frame
+        self.positions = np.empty_like(order)
+        self.positions[order] = np.arange(len(order))
+
+    def query(self, south, west, north, east, limit=None, max_position=None):
+        positions = np.sort(self.positions[self.index.query(south, west, north, east)])
+        if max_position is not None:
+            positions = positions[positions < max_position]
+        return positions[:limit]
+
+
+class WeightedView:
+    """Levels re-ranked with one weight vector.
+
+    Offers the same reading methods as ``CentresStore`` so the payload
+    cache and the table can use it in place of the shipped ranking. The
+    metric matrix, frame and grid index of a level are shared by all views
+    through ``levels``. A view keeps its scores and its ranked top N
+    frames; the fully ranked level is built on demand and only kept for
+    the views used most recently (see ``WeightedViews.full``).
+    """
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.weights = np.asarray(key, dtype='float64')
+        self.levels = levels
+        self.payloads = PayloadCache(self)
+        self._scores = {}  # level -> (content hash, scores)
+        self._tops = {}  # (level, n) -> (content hash, ranked frame)
+
+    def _score(self, level):
+        digest, df, matrix, index = self.levels.level(level)
+        cached = self._scores.get(level)
+        if cached is None or cached[0] != digest:
+            cached = (digest, matrix @ self.weights)
+            self._scores[level] = cached
+        return digest, df, index, cached[1]
+
+    def _ranked(self, df, scores, order):
+        # Equal scores share the best rank
+        ordered = -scores[order]
+        ranked = df.iloc[order].reset_index(drop=True)
+        ranked['rank'] = np.searchsorted(ordered, ordered, side='left') + 1
+        return ranked
+
+    def ranked_level(self, level, digest):
+        """Return ``(ranked frame, ReorderedIndex)`` of the whole level."""
+        _, df, index, scores = self._score(level)
+        order = np.argsort(-scores, kind='stable')
+        return self._ranked(df, scores, order), ReorderedIndex(index, order)
+
+    def versioned_top(self, level, n):
+        if n is None:
+            return self.versioned_frame(level)
+        digest, df, _, scores = self._score(level)
+        cached = self._tops.get((level, n))
+        if cached is None or cached[0] != digest:
+            cached = (digest, self._ranked(df, scores, top_positions(scores, n)))
+            if n in N_VALUES:
+                self._tops[(level, n)] = cached
+        return f'{digest}:{self.key}', cached[1]
+
+    def versioned_frame(self, level):
+        digest = self._score(level)[0]
+        return f'{digest}:{self.key}', self.levels.full(self, level, digest)[0]
+
+    def indexed_frame(self, level):
+        digest = self._score(level)[0]
+        frame, index = self.levels.full(self, level, digest)
+        return f'{digest}:{self.key}', frame, index
+
+    def frame(self, level):
+        return self.versioned_frame(level)[1]
+
+    def top_n(self, level, n):
+        return self.versioned_top(level, n)[1]
+
+    def label_column(self, level):
+        return LABEL_COLUMNS[level]
+
+
+class WeightedViews:
+    """Memoized ``WeightedView`` per quantized weight vector over one metrics store.
+
+    Holds the per-level data every view reads, so caching more weight
+    vectors only adds their scores and top N frames. Fully ranked levels,
+    which are as large as the level itself, are kept for the ``frames``
+    most recently used (view, level) pairs.
+    """
+
+    def __init__(self, metrics=metrics_store, maxsize=64, frames=8):
+        self.metrics = metrics
+        self.view = lru_cache(maxsize=maxsize)(self._view)
+        self.full = lru_cache(maxsize=frames)(self._full)
+        self._levels = {}  # level -> (content hash, frame, metric matrix, GridIndex)
+        self._lock = threading.Lock()
+
+    def _view(self, key):
+        return WeightedView(key, self)
+
+    def _full(self, view, level, digest):
+        # digest is part of the cache key, so a reloaded level is ranked again
+        return view.ranked_level(level, digest)
+
+    def available(self, level):
+        return self.metrics.available(level)
+
+    def level(self, level):
+        """Return ``(content hash, frame, metric matrix, GridIndex)`` of a level."""
+        digest, df = self.metrics.versioned_frame(level)
+        cached = self._levels.get(level)
+        if cached is None or cached[0] != digest:
+            with self._lock:
+                cached = self._levels.get(level)
+                if cached is None or cached[0] != digest:
+                    matrix = np.nan_to_num(df[METRICS].to_numpy(dtype='float64'))
+                    frame = df.drop(columns=METRICS)
+                    cached = (digest, frame, matrix, GridIndex(frame['lat'].values, frame['lon'].values))
+                    self._levels[level] = cached
+        return cached
+
+    def preload(self):
+        for level in LEVELS:
+            if self.available(level):
+                self.level(level)
+
+
+weighted_views = WeightedViews()
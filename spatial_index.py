@@ -0,0 +1,182 @@
+"""Grid index for viewport queries over a rank-sorted level frame.
+
+Points are bucketed into fixed-size lat/lon cells. A viewport query only
+inspects the cells overlapping the map bounds and returns row positions
+in rank order, because the indexed frame is already sorted by rank. The
+same index answers nearest-point queries for the spatial joins of the
+data pipeline (see spatial_join.py).
+"""
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def wrap_lon(lon):
+    """Bring a longitude reported after panning round the globe into [-180, 180]."""
+    if -180 <= lon <= 180:
+        return lon
+    return ((lon + 180) % 360) - 180
+
+
+def in_bounds(lat, lon, bounds):
+    """Boolean mask of the points inside Leaflet ``[[south, west], [north, east]]`` bounds."""
+    (south, west), (north, east) = bounds
+    inside = (lat >= south) & (lat <= north)
+    if east - west < 360:
+        west, east = wrap_lon(west), wrap_lon(east)
+        if west <= east:
+            inside &= (lon >= west) & (lon <= east)
+        else:
+            # Viewport crosses the antimeridian
+            inside &= (lon >= west) | (lon <= east)
+    return inside
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in kilometres, element-wise over arrays of degrees."""
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def max_features(zoom):
+    """Number of locations drawn at a zoom level, doubling per zoom step."""
+    if zoom is None:
+        zoom = 3
+    return int(min(500 * 2 ** max(zoom - 3, 0), 20000))
+
+
+class GridIndex:
+    """Uniform grid of ``cell_size`` degree cells over lat/lon points."""
+
+    def __init__(self, lat, lon, cell_size=1.0):
+        self.cell_size = cell_size
+        self.lat = np.asarray(lat, dtype='float64')
+        self.lon = np.asarray(lon, dtype='float64')
+        self.n_rows = int(np.ceil(180 / cell_size)) + 1
+        self.n_cols = int(np.ceil(360 / cell_size)) + 1
+
+        cells = self._cell_ids(self._row(self.lat), self._col(self.lon))
+        # A stable sort keeps points within a cell in rank order
+        order = np.argsort(cells, kind='stable')
+        self.cells, starts, counts = np.unique(cells[order], return_index=True, return_counts=True)
+        self.starts = starts
+        self.ends = starts + counts
+        self.positions = order
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _row(self, lat):
+        return np.floor((np.clip(lat, -90, 90) + 90) / self.cell_size).astype('int64')
+
+    def _col(self, lon):
+        return np.floor((np.clip(lon, -180, 180) + 180) / self.cell_size).astype('int64')
+
+    def _cell_ids(self, rows, cols):
+        return rows * self.n_cols + cols
+
+    def query(self, south, west, north, east, limit=None, max_position=None):
+        """Return rank-ordered row positions inside the bounds.
+
+        Only rows before ``max_position`` (the top-N cut-off) are
+        considered and at most ``limit`` positions are returned.
+        """
+        if east - west >= 360:
+            west, east = -180, 180
+        west, east = wrap_lon(west), wrap_lon(east)
+        if west > east:
+            # Viewport crosses the antimeridian
+            positions = np.union1d(self.query(south, west, north, 180, None, max_position),
+                                   self.query(south, -180, north, east, None, max_position))
+            return positions[:limit]
+
+        rows = np.arange(self._row(south), self._row(north) + 1)
+        cols = np.arange(self._col(west), self._col(east) + 1)
+        wanted = self._cell_ids(rows[:, None], cols[None, :]).ravel()
+
+        found = np.searchsorted(self.cells, wanted)
+        valid = found < len(self.cells)
+        found, wanted = found[valid], wanted[valid]
+        found = found[self.cells[found] == wanted]
+        if not len(found):
+            return np.empty(0, dtype='int64')
+
+        candidates = np.concatenate([self.positions[s:e] for s, e in zip(self.starts[found], self.ends[found])])
+        if max_position is not None:
+            candidates = candidates[candidates < max_position]
+
+        lat, lon = self.lat[candidates], self.lon[candidates]
+        inside = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+        return np.sort(candidates[inside])[:limit]
+
+    def _block_nearest(self, lat, lon, radius):
+        """Nearest point within ``radius`` cells of each query and whether it is certain.
+
+        The nearest candidate is certain when no point outside the block of
+        cells searched can be closer.
+        """
+        rows, cols = self._row(lat), self._col(lon)
+        offsets = np.arange(-radius, radius + 1)
+        wanted = self._cell_ids(rows[:, None, None] + offsets[None, :, None],
+                                cols[:, None, None] + offsets[None, None, :]).reshape(len(lat), -1)
+        found = np.minimum(np.searchsorted(self.cells, wanted), len(self.cells) - 1)
+        hit = self.cells[found] == wanted
+        starts = np.where(hit, self.starts[found], 0).ravel()
+        lengths = np.where(hit, self.ends[found] - self.starts[found], 0).ravel()
+
+        # Every (query, candidate) pair of the blocks, flattened
+        queries = np.repeat(np.repeat(np.arange(len(lat)), wanted.shape[1]), lengths)
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        candidates = self.positions[np.repeat(starts, lengths) + within]
+        distance = haversine_km(lat[queries], lon[queries], self.lat[candidates], self.lon[candidates])
+
+        order = np.lexsort((distance, queries))
+        queried, first = np.unique(queries[order], return_index=True)
+        best = np.full(len(lat), -1, dtype='int64')
+        best_distance = np.full(len(lat), np.inf)
+        best[queried] = candidates[order[first]]
+        best_distance[queried] = distance[order[first]]
+
+        # Distance from each query to the edges of its block
+        south = (rows - radius) * self.cell_size - 90
+        north = (rows + radius + 1) * self.cell_size - 90
+        west = (cols - radius) * self.cell_size - 180
+        east = (cols + radius + 1) * self.cell_size - 180
+        lat_margin = np.radians(np.minimum(lat - south, north - lat)) * EARTH_RADIUS_KM
+        lon_degrees = np.minimum(np.minimum(lon - west, east - lon), 90)
+        lon_margin = EARTH_RADIUS_KM * np.arcsin(np.cos(np.radians(lat)) * np.sin(np.radians(lon_degrees)))
+        # Blocks reaching a pole or the antimeridian miss neighbours on the other side
+        wraps = (south <= -90) | (north >= 90) | (west <= -180) | (east >= 180)
+        return best, ~wraps & (best_distance <= np.minimum(lat_margin, lon_margin))
+
+    def nearest(self, lat, lon, max_radius=16, chunk_size=4_000_000):
+        """Return the position of the indexed point nearest to each query point.
+
+        Each query searches the cells around it, widening the block up to
+        ``max_radius`` cells until its nearest candidate is certain. The
+        few queries still undecided are compared with every point,
+        ``chunk_size`` distances at a time. Returns -1 when the index is
+        empty.
+        """
+        lat = np.asarray(lat, dtype='float64')
+        lon = np.asarray(lon, dtype='float64')
+        best = np.full(len(lat), -1, dtype='int64')
+        if not len(self):
+            return best
+
+        undecided = np.arange(len(lat))
+        radius = 1
+        while len(undecided) and radius <= max_radius:
+            found, certain = self._block_nearest(lat[undecided], lon[undecided], radius)
+            best[undecided[certain]] = found[certain]
+            undecided = undecided[~certain]
+            radius *= 2
+
+        step = max(chunk_size // len(self), 1)
+        for i in range(0, len(undecided), step):
+            part = undecided[i:i + step]
+            distance = haversine_km(lat[part, None], lon[part, None], self.lat[None, :], self.lon[None, :])
+            best[part] = np.argmin(distance, axis=1)
+        return best
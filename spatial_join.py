@@ -0,0 +1,100 @@
+"""Spatial joins of tracts, cities, counties and states.
+
+A census tract's 11 digit GEOID starts with its two digit state and three
+digit county FIPS codes. Counties are keyed on those five digits rather
+than on their name, which is shared across states (Cook County is in
+Illinois and in Minnesota).
+
+Cities are placed in the county of their nearest tract centroid, found
+with a ``GridIndex`` and vectorized distances, and every county takes its
+most populous city. County and state centres are the area-weighted mean
+of their tracts' centroids. Everything is keyed one-to-one, so joining
+these lookups never repeats a tract.
+"""
+import numpy as np
+import pandas as pd
+
+from spatial_index import GridIndex
+
+
+def geoids(values):
+    """Census tract ids as zero-padded 11 character strings."""
+    ids = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(ids):
+        # Numeric ids lose the leading zero of states 01 to 09
+        ids = ids.astype('int64')
+    return ids.astype(str).str.zfill(11)
+
+
+def county_fips(tract_ids):
+    """The (state, county) FIPS code of each tract, e.g. ``'17031'`` for Cook County, Illinois."""
+    return geoids(tract_ids).str[:5].to_numpy()
+
+
+def city_counties(cities, tract_centres, cell_size=0.25):
+    """Add the ``county_fips`` of each city's nearest tract centroid.
+
+    ``cities`` has ``lat`` and ``lng`` as in the cities lookup and
+    ``tract_centres`` has ``GEOID10``, ``lat`` and ``lon``.
+    """
+    tract_centres = tract_centres.dropna(subset=['lat', 'lon'])
+    index = GridIndex(tract_centres['lat'].to_numpy(), tract_centres['lon'].to_numpy(), cell_size)
+    nearest = index.nearest(cities['lat'].to_numpy(), cities['lng'].to_numpy())
+    return cities.assign(county_fips=county_fips(tract_centres['GEOID10'].to_numpy()[nearest]))
+
+
+def county_cities(cities, tract_centres):
+    """The most populous city of each county, one row per ``county_fips``.
+
+    Ties go to the lowest city id. Returns ``county_fips``, ``city``,
+    ``city_lat``, ``city_lon`` and ``city_id``.
+    """
+    cities = city_counties(cities.dropna(subset=['lat', 'lng']), tract_centres)
+    top = (cities
+           .sort_values(['county_fips', 'population', 'id'], ascending=[True, False, True])
+           .drop_duplicates('county_fips'))
+    return (top
+            .rename(columns={'lat': 'city_lat', 'lng': 'city_lon', 'id': 'city_id'})
+            [['county_fips', 'city', 'city_lat', 'city_lon', 'city_id']]
+            .reset_index(drop=True))
+
+
+def mean_centres(lat, lon, weights, groups):
+    """Weighted mean position per group, averaged on the sphere.
+
+    Averaging unit vectors rather than degrees keeps groups that cross the
+    antimeridian (the Aleutians) in place.
+    """
+    lat, lon = np.radians(lat), np.radians(lon)
+    xyz = pd.DataFrame({
+        'x': np.cos(lat) * np.cos(lon) * weights,
+        'y': np.cos(lat) * np.sin(lon) * weights,
+        'z': np.sin(lat) * weights
+    }).groupby(groups).sum()
+    return pd.DataFrame({
+        'lat': np.degrees(np.arctan2(xyz['z'], np.hypot(xyz['x'], xyz['y']))),
+        'lon': np.degrees(np.arctan2(xyz['y'], xyz['x']))
+    }, index=xyz.index)
+
+
+def level_centres(tracts, tract_centres):
+    """County and state centres from the tract centroids.
+
+    ``tracts`` has ``Census_tract_ID``, ``County_Name``, ``State`` and
+    ``geo_area``. Returns the ``county`` lookup indexed by ``county_fips``
+    and labelled ``'<County_Name>, <State>'``, and the ``state`` lookup
+    indexed by ``State``, each with ``lat`` and ``lon``.
+    """
+    centres = tract_centres.assign(GEOID10=geoids(tract_centres['GEOID10']).to_numpy()).set_index('GEOID10')
+    located = tracts.assign(GEOID10=geoids(tracts['Census_tract_ID']).to_numpy()).join(
+        centres[['lat', 'lon']], on='GEOID10', how='inner')
+    located = located[located['geo_area'] > 0]
+    located = located.assign(county_fips=county_fips(located['GEOID10']))
+
+    args = (located['lat'].to_numpy(), located['lon'].to_numpy(), located['geo_area'].to_numpy())
+    county = mean_centres(*args, located['county_fips'].to_numpy()).rename_axis('county_fips')
+    labels = located.drop_duplicates('county_fips').set_index('county_fips')
+    county.insert(0, 'county_name', labels['County_Name'] + ', ' + labels['State'])
+    state = mean_centres(*args, located['State'].to_numpy())
+    state.insert(0, 'state', state.index)
+    return {'county': county, 'state': state}
@@ -0,0 +1,114 @@
+"""Server-side filtering, sorting and paging for the ranking DataTable.
+
+Dash sends the table state as ``filter_query``, ``sort_by``,
+``page_current`` and ``page_size``. These helpers translate that state
+into vectorized pandas operations on the cached level frames so only the
+requested page is sent back to the browser.
+"""
+import math
+import re
+
+import pandas as pd
+
+
+# Matches one ``{column} operator value`` term of a filter query
+FILTER_TERM = re.compile(
+    r'^\{(?P<column>[^}]+)\}\s*'
+    r'(?P<flags>[si]?)'
+    r'(?P<operator>>=|<=|!=|=|<|>|eq|ne|lt|le|gt|ge|contains|datestartswith|is blank)'
+    r'\s*(?P<value>.*)$'
+)
+
+OPERATORS = {
+    'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>=',
+}
+
+
+def parse_value(value, numeric=True):
+    """Strip quotes from a filter value, converting bare numbers unless ``numeric`` is False."""
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'`':
+        return value[1:-1]
+    if not numeric:
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def term_mask(df, column, operator, value, case=True):
+    """Return a boolean mask for a single filter term."""
+    series = df[column]
+    operator = OPERATORS.get(operator, operator)
+
+    if operator == 'is blank':
+        return series.isna() | (series.astype(str).str.strip() == '')
+    if operator == 'contains':
+        return series.astype(str).str.contains(str(value), case=case, regex=False)
+    if operator == 'datestartswith':
+        return series.astype(str).str.startswith(str(value))
+
+    numeric = pd.api.types.is_numeric_dtype(series)
+    if numeric and isinstance(value, float):
+        left = series
+    else:
+        left = series.astype(str)
+        value = value if isinstance(value, str) else f'{value:g}'
+        if not case:
+            left, value = left.str.lower(), value.lower()
+
+    if operator == '=':
+        return left == value
+    if operator == '!=':
+        return left != value
+    if operator == '<':
+        return left < value
+    if operator == '<=':
+        return left <= value
+    if operator == '>':
+        return left > value
+    return left >= value
+
+
+def filter_mask(df, filter_query):
+    """Translate a Dash ``filter_query`` string into a boolean mask.
+
+    Terms joined with ``&&`` are combined with a logical and; terms that
+    cannot be parsed or refer to unknown columns are ignored.
+    """
+    mask = pd.Series(True, index=df.index)
+    if not filter_query:
+        return mask
+    for term in filter_query.split(' && '):
+        match = FILTER_TERM.match(term.strip())
+        if match is None or match['column'] not in df:
+            continue
+        # Text operators match the value as typed, '5' rather than '5.0'
+        text = match['operator'] in ('contains', 'datestartswith')
+        mask &= term_mask(df, match['column'], match['operator'],
+                          parse_value(match['value'], numeric=not text), case=match['flags'] != 'i')
+    return mask
+
+
+def query_page(df, page_current=0, page_size=10, sort_by=None, filter_query=None):
+    """Filter, sort and slice a frame, returning ``(page, page_count)``.
+
+    ``page_current`` is clamped to the pages the filtered frame has.
+    """
+    if filter_query:
+        df = df[filter_mask(df, filter_query).values]
+
+    sort_by = [s for s in (sort_by or []) if s['column_id'] in df]
+    if sort_by:
+        df = df.sort_values(
+            [s['column_id'] for s in sort_by],
+            ascending=[s['direction'] == 'asc' for s in sort_by],
+            kind='mergesort'
+        )
+
+    page_count = max(math.ceil(len(df) / page_size), 1)
+    # A page past the end (after filtering from a later page) shows the last one
+    page_current = min(max(page_current, 0), page_count - 1)
+    start = page_current * page_size
+    return df.iloc[start:start + page_size], page_count
@@ -0,0 +1,60 @@
+"""Small synthetic screening tool inputs shared by the tests."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from incremental import DESCRIPTION_COLS
+from precompute import EJST_RENAMES, centres_lookups, tract_frame
+from spatial_join import county_cities
+
+
+# (state FIPS, name, lat, lon); Alaska's Aleutians cross the antimeridian
+STATES = [
+    (17, 'Illinois', 40.0, -89.2),
+    (27, 'Minnesota', 46.3, -94.3),
+    (2, 'Alaska', 52.0, 179.5)
+]
+
+
+def wrap(lon):
+    return (lon + 180) % 360 - 180
+
+
+def synthetic_inputs(seed=0, counties=3, tracts=5, cities=2):
+    """Return the screening tool rows, tract centroids and cities lookup of a few counties.
+
+    Both Illinois and Minnesota have a Cook County, so county names repeat
+    across states as they do in the real data.
+    """
+    rng = np.random.default_rng(seed)
+    source = {new: old for old, new in EJST_RENAMES.items()}
+    rows, centroids, places = [], [], []
+    for state_fips, state, lat, lon in STATES:
+        for county in range(1, counties + 1):
+            name = 'Cook County' if county == 1 else f'County {county}'
+            county_lat, county_lon = lat + rng.uniform(-1, 1), lon + rng.uniform(-1, 1)
+            for tract in range(tracts):
+                geoid = int(f'{state_fips:02d}{county:03d}{tract:06d}')
+                rows.append((geoid, name, state))
+                centroids.append((geoid, county_lat + rng.normal(0, 0.05), wrap(county_lon + rng.normal(0, 0.05))))
+            for _ in range(cities):
+                places.append((f'City {len(places)}', int(rng.integers(1000, 100000)),
+                               county_lat + rng.normal(0, 0.02), wrap(county_lon + rng.normal(0, 0.02)), len(places)))
+
+    ejst = pd.DataFrame(rows, columns=['Census_tract_ID', 'County_Name', 'State'])
+    ejst['Total_population'] = rng.integers(100, 9000, len(ejst)).astype(float)
+    ejst['geo_area'] = rng.uniform(1, 50, len(ejst))
+    for metric in DESCRIPTION_COLS:
+        ejst[source.get(metric, metric)] = rng.uniform(0, 1, len(ejst)).round(2)
+    tract_centres = pd.DataFrame(centroids, columns=['GEOID10', 'lat', 'lon'])
+    city_lookup = pd.DataFrame(places, columns=['city', 'population', 'lat', 'lng', 'id'])
+    return ejst, tract_centres, city_lookup
+
+
+@pytest.fixture
+def inputs():
+    """``(tracts, centres)`` as ``precompute`` prepares them for ``publish``."""
+    ejst, tract_centres, cities = synthetic_inputs()
+    city_lookup = county_cities(cities, tract_centres)
+    tracts = tract_frame(ejst, city_lookup)
+    return tracts, centres_lookups(tracts, tract_centres, city_lookup)
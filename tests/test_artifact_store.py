@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from artifact_store import MANIFEST, ArtifactStore, write_atomic
+
+
+def publish(artifacts, files, base=None, **metadata):
+    with artifacts.new_version(base=base, **metadata) as staging:
+        for name, text in files.items():
+            write_atomic(os.path.join(staging, name), text)
+    return artifacts.current()
+
+
+def read(artifacts, version, name):
+    with open(os.path.join(artifacts.path(version), name)) as f:
+        return f.read()
+
+
+def test_publish_and_verify(tmp_path):
+    artifacts = ArtifactStore(str(tmp_path))
+    assert artifacts.current() is None
+
+    version = publish(artifacts, {'state_centres.arrow': 'a', 'city_centres.arrow': 'b'}, source='test')
+
+    assert artifacts.versions() == [version]
+    manifest = artifacts.verify(version)
+    assert sorted(manifest['files']) == ['city_centres.arrow', 'state_centres.arrow']
+    assert manifest['source'] == 'test' and manifest['base'] is None
+    assert not any(name.startswith('.') for name in os.listdir(artifacts.versions_dir))
+
+
+def test_incremental_version_keeps_its_base(tmp_path):
+    artifacts = ArtifactStore(str(tmp_path))
+    base = publish(artifacts, {'state_centres.arrow': 'a', 'city_centres.arrow': 'b'})
+
+    version = publish(artifacts, {'city_centres.arrow': 'c'}, base=base)
+
+    assert version != base and artifacts.current() == version
+    assert artifacts.manifest(version)['base'] == base
+    assert read(artifacts, version, 'state_centres.arrow') == 'a'
+    assert read(artifacts, version, 'city_centres.arrow') == 'c'
+    # The replaced file of the new version is not the base's
+    assert read(artifacts, base, 'city_centres.arrow') == 'b'
+    artifacts.verify(base)
+    artifacts.verify(version)
+
+
+def test_verify_detects_changed_and_missing_files(tmp_path):
+    artifacts = ArtifactStore(str(tmp_path))
+    version = publish(artifacts, {'state_centres.arrow': 'a', 'city_centres.arrow': 'b'})
+
+    with open(os.path.join(artifacts.path(version), 'state_centres.arrow'), 'w') as f:
+        f.write('x')
+    with pytest.raises(ValueError, match='state_centres.arrow does not match'):
+        artifacts.verify(version)
+
+    os.remove(os.path.join(artifacts.path(version), 'city_centres.arrow'))
+    with pytest.raises(ValueError, match='city_centres.arrow is missing'):
+        artifacts.verify(version)
+
+
+def test_failed_publish_keeps_the_current_version(tmp_path):
+    artifacts = ArtifactStore(str(tmp_path))
+    version = publish(artifacts, {'state_centres.arrow': 'a'})
+
+    with pytest.raises(RuntimeError):
+        with artifacts.new_version(base=version) as staging:
+            write_atomic(os.path.join(staging, 'state_centres.arrow'), 'half written')
+            raise RuntimeError('export failed')
+
+    assert artifacts.current() == version
+    assert artifacts.versions() == [version]
+    assert os.listdir(artifacts.versions_dir) == [version]
+    artifacts.verify(version)
+
+
+def test_prune_keeps_the_newest_and_the_current_version(tmp_path):
+    artifacts = ArtifactStore(str(tmp_path), keep=2)
+    versions = [publish(artifacts, {'state_centres.arrow': str(i)}) for i in range(4)]
+
+    assert artifacts.versions() == versions[-2:]
+    assert MANIFEST in os.listdir(artifacts.path(versions[-1]))
+
+    # A rollback to an older version survives the next prune
+    write_atomic(os.path.join(artifacts.root, 'CURRENT'), versions[-2])
+    artifacts.keep = 1
+    artifacts.prune()
+    assert artifacts.versions() == versions[-2:]
@@ -0,0 +1,47 @@
+import numpy as np
+
+from clustering import CELL_BITS, ClusterPyramid, mercator
+
+
+def cells(x, y, zoom):
+    scale = 2 ** (zoom + CELL_BITS)
+    return (y * scale).astype('int64') << 32 | (x * scale).astype('int64')
+
+
+def test_clusters_hold_every_point_at_every_zoom():
+    rng = np.random.default_rng(0)
+    lat, lon = rng.uniform(25, 50, 500), rng.uniform(-125, -65, 500)
+    pyramid = ClusterPyramid(lat, lon, np.arange(1, 501), max_zoom=8)
+
+    for zoom in range(9):
+        level = pyramid.level(zoom)
+        assert level.count.sum() == 500
+        assert level.rank_sum.sum() == np.arange(1, 501).sum()
+    assert pyramid.level(9) is None
+
+
+def test_expansion_zoom_is_where_a_cluster_splits():
+    rng = np.random.default_rng(1)
+    # Tight groups, so clusters stay whole over several zooms
+    centres = rng.uniform([30, -120], [45, -70], (12, 2))
+    points = np.repeat(centres, 20, axis=0) + rng.normal(0, 0.05, (240, 2))
+    lat, lon = points[:, 0], points[:, 1]
+    max_zoom = 10
+    pyramid = ClusterPyramid(lat, lon, np.arange(len(lat)), max_zoom=max_zoom)
+    x, y = mercator(lat, lon)
+
+    for zoom in range(max_zoom + 1):
+        level = pyramid.level(zoom)
+        of_point = cells(x, y, zoom)
+        for key, expansion_zoom in zip(level.cy << 32 | level.cx, level.expansion_zoom):
+            leaves = of_point == key
+            expected = next((z for z in range(zoom + 1, max_zoom + 1) if len(np.unique(cells(x[leaves], y[leaves], z))) > 1),
+                            max_zoom + 1)
+            assert expansion_zoom == expected, (zoom, key)
+
+
+def test_subset_keeps_expansion_zoom():
+    pyramid = ClusterPyramid([40.0, 40.001, 10.0], [-100.0, -100.001, 10.0], [1, 2, 3], max_zoom=6)
+    level = pyramid.level(3)
+    subset = level.subset(np.array([0]))
+    assert subset.expansion_zoom.tolist() == level.expansion_zoom[:1].tolist()
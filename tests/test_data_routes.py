@@ -0,0 +1,55 @@
+import json
+import os
+
+from artifact_store import ArtifactStore
+from data_routes import BODIES_INDEX, EXTENSIONS, body_name, write_bodies
+from data_store import LEVELS
+from datasets import Dataset
+from incremental import RankingState
+from payloads import N_VALUES
+from precompute import publish
+
+
+def incremental_publish(artifacts, tracts, centres, changed):
+    """Publish ``changed`` tracts the way the notebook's incremental mode does."""
+    state = RankingState.from_tracts(tracts)
+    updated = tracts.copy()
+    updated.loc[changed, 'PM25'] = 1.0 - updated.loc[changed, 'PM25']
+    levels = state.sync(updated)
+    base = artifacts.current()
+    with artifacts.new_version(base=base, source='test', mode='incremental') as version_dir:
+        state.write_artifacts(levels, centres, version_dir)
+        write_bodies(version_dir)
+    return base, artifacts.current(), levels
+
+
+def test_incremental_publish_leaves_the_base_version_intact(tmp_path, inputs):
+    tracts, centres = inputs
+    artifacts = ArtifactStore(str(tmp_path))
+    publish(artifacts, tracts, centres, source='test')
+
+    base, version, levels = incremental_publish(artifacts, tracts, centres, tracts.index[:3])
+
+    assert levels and version != base
+    artifacts.verify(base)
+    artifacts.verify(version)
+    with open(os.path.join(artifacts.path(base), BODIES_INDEX)) as f:
+        published = json.load(f)
+    with open(os.path.join(artifacts.path(version), BODIES_INDEX)) as f:
+        updated = json.load(f)
+    assert published != updated
+
+
+def test_workers_serve_the_published_bodies(tmp_path, inputs):
+    tracts, centres = inputs
+    artifacts = ArtifactStore(str(tmp_path))
+    version = publish(artifacts, tracts, centres, source='test')
+    with open(os.path.join(artifacts.path(version), BODIES_INDEX)) as f:
+        published = json.load(f)
+
+    routes = Dataset.load(artifacts.path(version), version).routes
+    for level in LEVELS:
+        for n in N_VALUES:
+            for kind, ext in EXTENSIONS.items():
+                etag = published[body_name(kind, level, n)]['etag']
+                assert routes.url(kind, level, n) == f'/data/{kind}/{level}/{n}/{etag}.{ext}'
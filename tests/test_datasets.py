@@ -0,0 +1,51 @@
+from flask import Flask
+
+from artifact_store import ArtifactStore
+from datasets import ActiveDataset
+from precompute import publish
+
+
+def worker(artifacts):
+    """An app worker serving the current version, as app.py sets it up."""
+    active = ActiveDataset(artifacts)
+    active.dataset.warm()
+    server = Flask(__name__)
+    active.dataset.routes.register(server, lambda: active.dataset.routes)
+    return active, server.test_client()
+
+
+def reversed_pm25(tracts):
+    return tracts.assign(PM25=1.0 - tracts['PM25'])
+
+
+def test_workers_on_different_versions_serve_each_others_urls(tmp_path, inputs):
+    tracts, centres = inputs
+    artifacts = ArtifactStore(str(tmp_path))
+    publish(artifacts, tracts, centres, source='test')
+    upgraded, upgraded_client = worker(artifacts)
+    stale, stale_client = worker(artifacts)
+    old_url = stale.dataset.routes.table_url('county', 20)
+
+    publish(artifacts, reversed_pm25(tracts), centres, source='test')
+    assert upgraded.refresh()
+    new_url = upgraded.dataset.routes.table_url('county', 20)
+
+    assert new_url != old_url
+    assert stale_client.get(new_url).status_code == 200
+    assert upgraded_client.get(old_url).status_code == 200
+    assert stale_client.get(new_url).data == upgraded_client.get(new_url).data
+    assert stale_client.get(new_url.replace('/county/', '/state/')).status_code == 404
+
+
+def test_a_pruned_version_is_still_served(tmp_path, inputs):
+    tracts, centres = inputs
+    artifacts = ArtifactStore(str(tmp_path), keep=1)
+    first = publish(artifacts, tracts, centres, source='test')
+    active, client = worker(artifacts)
+
+    publish(artifacts, reversed_pm25(tracts), centres, source='test')
+    assert first not in artifacts.versions()
+
+    assert active.dataset.version == first
+    assert len(active.dataset.centres.top_n('county', 5)) == 5
+    assert client.get(active.dataset.routes.map_url('county', 20)).status_code == 200
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_store import LABEL_COLUMNS
+from incremental import LEVEL_KEYS, TOTAL_COLUMNS, RankingState
+
+
+def updated(tracts):
+    """A later load of the tracts with changed, moved, removed and new ones."""
+    rng = np.random.default_rng(5)
+    after = tracts.copy()
+    changed = after.index[[0, 7, 19, 30]]
+    after.loc[changed, 'PM25'] = rng.uniform(0, 1, len(changed)).round(2)
+    after.loc[after.index[11], 'Asthma'] = np.nan
+    # Density changes move the density percentile of other tracts too
+    after.loc[after.index[[3, 25]], 'Total_population'] *= 4
+    after.loc[after.index[14], 'city_id'] = np.nan
+    after = after.drop(index=after.index[[2, 20, 40]])
+
+    new = tracts.iloc[[5, 33]].copy()
+    new['Census_tract_ID'] = new['Census_tract_ID'] + 900000
+    new['Traffic_Proximity'] = [0.99, 0.01]
+    return pd.concat([after, new], ignore_index=True)
+
+
+def ranked(state, level, centres):
+    frame = state.level_frame(level, centres[level], metrics=True)
+    return frame.sort_values(['rank', LABEL_COLUMNS[level]]).reset_index(drop=True)
+
+
+def test_sync_matches_a_full_rebuild(inputs):
+    tracts, centres = inputs
+    after = updated(tracts)
+    state = RankingState.from_tracts(tracts)
+
+    assert set(state.sync(after)) == set(LEVEL_KEYS)
+
+    rebuilt = RankingState.from_tracts(after)
+    for level in LEVEL_KEYS:
+        expected = rebuilt.levels[level].totals.sort_index()
+        totals = state.levels[level].totals.sort_index()
+        # city_id turns float once a tract has no city, so compare values
+        assert totals.index.tolist() == expected.index.tolist()
+        np.testing.assert_allclose(totals[TOTAL_COLUMNS].to_numpy(), expected[TOTAL_COLUMNS].to_numpy(), atol=1e-9)
+        pd.testing.assert_frame_equal(ranked(state, level, centres), ranked(rebuilt, level, centres))
+
+
+def test_sync_without_changes_republishes_nothing(inputs):
+    tracts, _ = inputs
+    state = RankingState.from_tracts(tracts)
+    assert state.sync(tracts.copy()) == []
+
+
+@pytest.mark.parametrize('column', ['Agricultural_Loss_Rate', 'Total_population'])
+def test_a_change_to_the_last_group_is_republished(inputs, column):
+    tracts, _ = inputs
+    state = RankingState.from_tracts(tracts)
+    last = state.levels['county'].keys[-1]
+    tract = tracts.index[tracts['county_fips'] == last][0]
+
+    after = tracts.copy()
+    after.loc[tract, column] = after.loc[tract, column] * 0.5 + 0.001
+    assert 'county' in state.sync(after)
+
+
+def test_tracts_without_a_city_are_not_a_city(inputs):
+    tracts, _ = inputs
+    tracts = tracts.copy()
+    tracts.loc[tracts.index[:4], 'city_id'] = np.nan
+    state = RankingState.from_tracts(tracts)
+
+    totals = state.levels['city'].totals
+    assert not totals.index.isna().any()
+    assert totals['tracts'].sum() == len(tracts) - 4
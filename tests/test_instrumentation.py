@@ -0,0 +1,69 @@
+import json
+import tracemalloc
+
+import pytest
+
+import instrumentation
+
+
+MB = 1 << 20
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    """Enable metrics and memory on fresh histograms."""
+    monkeypatch.setattr(instrumentation, 'ENABLED', True)
+    monkeypatch.setattr(instrumentation, 'MEMORY', True)
+    fresh = tuple(metric.empty() for metric in instrumentation.METRICS)
+    for name, metric in zip(('stage_seconds', 'response_bytes', 'cache_requests', 'stage_memory'), fresh):
+        monkeypatch.setattr(instrumentation, name, metric)
+    monkeypatch.setattr(instrumentation, 'METRICS', fresh)
+    tracemalloc.start()
+    yield
+    tracemalloc.stop()
+
+
+def peak(stage, level):
+    _, total, count = instrumentation.stage_memory._series[(('level', level), ('stage', stage))]
+    assert count == 1
+    return total
+
+
+def test_memory_of_nested_stages(metrics):
+    with instrumentation.timed('outer', 'county'):
+        before = bytearray(4 * MB)
+        del before
+        with instrumentation.timed('inner', 'county'):
+            data = bytearray(MB)
+            del data
+        kept = bytearray(2 * MB)
+
+    inner, outer = peak('inner', 'county'), peak('outer', 'county')
+    assert MB <= inner < 2 * MB
+    # The outer stage's own peak came before the inner stage reset it
+    assert 4 * MB <= outer < 5 * MB
+    assert (('level', 'county'), ('stage', 'inner')) in instrumentation.stage_seconds._series
+    del kept
+
+
+def test_memory_is_off_by_default(monkeypatch):
+    monkeypatch.setattr(instrumentation, 'MEMORY', False)
+    fresh = instrumentation.stage_memory.empty()
+    monkeypatch.setattr(instrumentation, 'stage_memory', fresh)
+    with instrumentation.measured('read', 'state'):
+        bytearray(MB)
+    assert fresh._series == {}
+
+
+def test_metrics_of_every_worker_are_summed(metrics, tmp_path, monkeypatch):
+    monkeypatch.setattr(instrumentation, 'METRICS_DIR', str(tmp_path))
+    instrumentation.count('payload', True, 'state')
+    other = instrumentation.cache_requests.empty()
+    other.inc(cache='payload', result='hit', level='state')
+    other.inc(cache='payload', result='miss', level='state')
+    with open(tmp_path / '1.json', 'w') as f:
+        json.dump([[], [], other.snapshot(), []], f)
+
+    lines = instrumentation.render().splitlines()
+    assert 'dashboard_cache_requests_total{cache="payload",level="state",result="hit"} 2' in lines
+    assert 'dashboard_cache_requests_total{cache="payload",level="state",result="miss"} 1' in lines
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from artifact_store import ArtifactStore
+from data_store import CentresStore
+from incremental import METRICS
+from precompute import publish
+from scoring import WeightedViews, quantize_weights, top_positions
+
+
+@pytest.mark.parametrize('n', [0, 1, 5, 17, 40, 100])
+def test_top_positions_is_the_start_of_a_stable_sort(n):
+    # Few distinct values, so the cut falls inside a run of ties
+    scores = np.random.default_rng(n).integers(0, 6, 40).astype('float64')
+    expected = np.argsort(-scores, kind='stable')[:n]
+    np.testing.assert_array_equal(top_positions(scores, n), expected)
+
+
+@pytest.fixture
+def views(tmp_path, inputs):
+    tracts, centres = inputs
+    artifacts = ArtifactStore(str(tmp_path))
+    version = publish(artifacts, tracts, centres, source='test')
+    return WeightedViews(CentresStore(artifacts.path(version), name='metrics', versioned=True))
+
+
+def test_view_ranks_by_weighted_sums(views):
+    key = quantize_weights([0, 2, 1, 0, 1, 0, 3, 1])
+    view = views.view(key)
+    _, metrics = views.metrics.versioned_frame('county')
+    scores = np.nan_to_num(metrics[METRICS].to_numpy()) @ np.asarray(key)
+
+    frame = view.frame('county')
+    np.testing.assert_array_equal(frame['county_name'], metrics['county_name'].to_numpy()[np.argsort(-scores, kind='stable')])
+    assert frame['rank'].iloc[0] == 1 and frame['rank'].is_monotonic_increasing
+    assert view.top_n('county', 5).equals(frame.iloc[:5])
+
+
+def test_view_memoizes_top_n_and_the_ranked_level(views):
+    view = views.view(quantize_weights([1, 0, 0, 0, 0, 0, 0, 0]))
+    assert view.top_n('state', 20) is view.top_n('state', 20)
+    assert view.frame('state') is view.frame('state')
+    digest, frame, index = view.indexed_frame('state')
+    assert frame is view.frame('state')
+    assert view.indexed_frame('state')[2] is index
+    positions = index.query(-90, -180, 90, 180)
+    np.testing.assert_array_equal(positions, np.arange(len(frame)))
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from spatial_index import GridIndex, haversine_km, in_bounds
+
+
+def points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    lat = np.concatenate([rng.uniform(-85, 85, n), rng.uniform(50, 56, n // 4)])
+    # A cluster on each side of the antimeridian, as in the Aleutians
+    lon = np.concatenate([rng.uniform(-180, 180, n), rng.uniform(-180, 180, n // 4) % 10 + 172])
+    lon = ((lon + 180) % 360) - 180
+    return lat, lon
+
+
+@pytest.mark.parametrize('bounds', [
+    [[30, -100], [50, -80]],
+    [[-90, -180], [90, 180]],
+    [[45, 170], [60, -170]],  # across the antimeridian
+    [[45, 170], [60, 190]],  # the same, as Leaflet reports it after panning east
+    [[45, -190], [60, -170]],
+    [[-10, -400], [10, 400]],  # zoomed out past a whole world
+    [[10, 20], [10.5, 20.5]],
+])
+def test_query_matches_brute_force(bounds):
+    lat, lon = points(2000)
+    index = GridIndex(lat, lon, cell_size=2.0)
+    (south, west), (north, east) = bounds
+    expected = np.flatnonzero(in_bounds(lat, lon, bounds))
+
+    np.testing.assert_array_equal(index.query(south, west, north, east), expected)
+    np.testing.assert_array_equal(index.query(south, west, north, east, limit=7), expected[:7])
+    np.testing.assert_array_equal(index.query(south, west, north, east, max_position=500),
+                                  expected[expected < 500])
+
+
+def test_query_of_an_empty_area():
+    index = GridIndex([10.0, 20.0], [10.0, 20.0])
+    assert len(index.query(-50, -50, -40, -40)) == 0
+
+
+@pytest.mark.parametrize('cell_size', [0.25, 1.0, 5.0])
+def test_nearest_matches_brute_force(cell_size):
+    lat, lon = points(1500, seed=1)
+    index = GridIndex(lat, lon, cell_size=cell_size)
+    rng = np.random.default_rng(2)
+    # Queries everywhere, at the poles and either side of the antimeridian
+    q_lat = np.concatenate([rng.uniform(-90, 90, 300), [89.9, -89.9, 52.0, 52.0, 53.0]])
+    q_lon = np.concatenate([rng.uniform(-180, 180, 300), [0.0, 45.0, 179.99, -179.99, -180.0]])
+
+    found = index.nearest(q_lat, q_lon)
+    distances = haversine_km(q_lat[:, None], q_lon[:, None], lat[None, :], lon[None, :])
+    # Compare distances, equally near points may be picked either way
+    np.testing.assert_allclose(distances[np.arange(len(q_lat)), found], distances.min(axis=1))
+
+
+def test_nearest_across_the_antimeridian():
+    index = GridIndex([52.0, 52.0], [179.9, 170.0], cell_size=0.25)
+    assert index.nearest([52.0], [-179.9]).tolist() == [0]
+
+
+def test_nearest_without_points():
+    assert GridIndex([], []).nearest([1.0, 2.0], [3.0, 4.0]).tolist() == [-1, -1]
@@ -0,0 +1,90 @@
+import pandas as pd
+import pytest
+
+from table_query import filter_mask, parse_value, query_page
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({
+        'county_name': ['Cook County, Illinois', 'Cook County, Minnesota', 'Lake County, Illinois',
+                        'Kings County, New York', None, 'Route 5 County, Texas'],
+        'rank': [1, 2, 3, 4, 5, 6],
+        'lat': [41.8, 47.8, 42.3, 40.6, 35.0, 31.0],
+        'description': ['Ranks highly in: PM25: 99%', 'Ranks highly in: Asthma: 50%', '', 'Ranks highly in: PM25: 5%',
+                        'Ranks highly in: Traffic_Proximity: 75%', 'Ranks highly in: Asthma: 5%']
+    })
+
+
+def names(df, filter_query):
+    return df.loc[filter_mask(df, filter_query).values, 'rank'].tolist()
+
+
+def test_parse_value():
+    assert parse_value(' 5 ') == 5.0
+    assert parse_value('"5"') == '5'
+    assert parse_value('5', numeric=False) == '5'
+    assert parse_value('Cook') == 'Cook'
+
+
+@pytest.mark.parametrize('filter_query, expected', [
+    ('{rank} > 4', [5, 6]),
+    ('{rank} gt 4', [5, 6]),
+    ('{rank} >= 4', [4, 5, 6]),
+    ('{rank} < 2', [1]),
+    ('{rank} le 2', [1, 2]),
+    ('{rank} = 3', [3]),
+    ('{rank} != 3', [1, 2, 4, 5, 6]),
+    ('{lat} ge 41.8', [1, 2, 3]),
+    ('{county_name} contains Illinois', [1, 3]),
+    ('{county_name} = "Lake County, Illinois"', [3]),
+    ('{county_name} datestartswith Cook', [1, 2]),
+    ('{county_name} is blank', [5]),
+    ('{description} is blank', [3]),
+    ('{rank} > 1 && {county_name} contains Cook', [2]),
+])
+def test_operators(df, filter_query, expected):
+    assert names(df, filter_query) == expected
+
+
+def test_contains_matches_numbers_as_typed(df):
+    # '5' used to become 5.0 and match nothing
+    assert names(df, '{description} contains 5%') == [4, 5, 6]
+    assert names(df, '{county_name} contains 5') == [6]
+    assert names(df, '{rank} contains 5') == [5]
+
+
+def test_case_flags(df):
+    assert names(df, '{county_name} contains cook') == []
+    assert names(df, '{county_name} scontains cook') == []
+    assert names(df, '{county_name} icontains cook') == [1, 2]
+    assert names(df, '{county_name} i= "cook county, illinois"') == [1]
+    assert names(df, '{county_name} s= "cook county, illinois"') == []
+
+
+def test_unknown_columns_and_unparsed_terms_are_ignored(df):
+    assert names(df, '{population} > 3') == [1, 2, 3, 4, 5, 6]
+    assert names(df, 'rank > 3 && {rank} > 4') == [5, 6]
+    assert names(df, '') == [1, 2, 3, 4, 5, 6]
+
+
+def test_sort_and_page(df):
+    page, page_count = query_page(df, 1, 4, sort_by=[{'column_id': 'lat', 'direction': 'desc'}])
+    assert page_count == 2
+    assert page['rank'].tolist() == [5, 6]
+
+    page, _ = query_page(df, 0, 3, sort_by=[{'column_id': 'missing', 'direction': 'asc'}])
+    assert page['rank'].tolist() == [1, 2, 3]
+
+
+@pytest.mark.parametrize('page_current, expected', [(0, [1, 2]), (3, [1, 2]), (-1, [1, 2])])
+def test_page_is_clamped_to_the_filtered_pages(df, page_current, expected):
+    # Filtering from a later page leaves fewer pages than the current one
+    page, page_count = query_page(df, page_current, 2, filter_query='{county_name} contains Cook')
+    assert page_count == 1
+    assert page['rank'].tolist() == expected
+
+
+def test_empty_result_has_one_page(df):
+    page, page_count = query_page(df, 2, 2, filter_query='{rank} > 10')
+    assert page_count == 1 and page.empty
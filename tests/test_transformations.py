@@ -0,0 +1,84 @@
+"""The one-pass descriptions of ``transformations`` against the notebook's per-level ones.
+
+Before ``description_percentiles`` the notebook summed every level on its
+own, percent-ranked each metric over an unpartitioned window and kept the
+three largest with ``melt`` and ``nlargest``. ``reference`` repeats those
+steps in pandas on a small fixture and every level must come out the same,
+and the same as the incremental ranking's ``describe``.
+"""
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyspark')
+
+from incremental import describe
+from pyspark.sql import SparkSession
+from transformations import (DESCRIPTION_COLS, DESCRIPTION_LEVELS, description_percentiles,
+                             level_descriptions, top_descriptions, with_county_fips)
+
+
+# Small integer metrics so that sums tie within and across metrics. The
+# two Springfields are different cities and one tract has no city.
+TRACTS = pd.DataFrame([
+    (1001020100, 'Alabama', 1, 'Prattville', 3, 1, 2, 0, 1, 4, 2),
+    (1001020200, 'Alabama', 1, 'Prattville', 1, 1, 0, 2, 2, 0, 1),
+    (1003010100, 'Alabama', 2, 'Springfield', 2, 3, 1, 1, 0, 2, 2),
+    (1003010200, 'Alabama', 3, 'Fairhope', 0, 2, 2, 3, 1, 1, 0),
+    (6037101110, 'California', 4, 'Los Angeles', 4, 4, 1, 0, 3, 0, 4),
+    (6037101122, 'California', 4, 'Los Angeles', 2, 0, 3, 1, 1, 1, 3),
+    (6059001101, 'California', 5, 'Anaheim', 1, 2, 2, 2, 0, 3, 1),
+    (6059001102, 'California', None, None, 3, 1, 0, 4, 2, 2, 0),
+    (17031010100, 'Illinois', 6, 'Chicago', 4, 3, 4, 0, 0, 1, 4),
+    (17031010201, 'Illinois', 6, 'Chicago', 0, 1, 1, 2, 4, 0, 2),
+    (17043840000, 'Illinois', 7, 'Springfield', 2, 2, 3, 1, 1, 2, 1),
+    (17043840100, 'Illinois', 8, 'Wheaton', 1, 0, 0, 3, 3, 3, 3),
+], columns=['census_tract_id', 'state', 'city_id', 'city', *DESCRIPTION_COLS])
+# Python ints and None, which Spark reads as a nullable long column
+TRACTS['city_id'] = pd.Series([None if pd.isna(v) else int(v) for v in TRACTS['city_id']], dtype=object)
+
+
+@pytest.fixture(scope='module')
+def spark():
+    session = (SparkSession.builder
+               .master('local[1]')
+               .config('spark.sql.shuffle.partitions', '1')
+               .getOrCreate())
+    yield session
+    session.stop()
+
+
+@pytest.fixture(scope='module')
+def descriptions(spark):
+    full_df = with_county_fips(spark.createDataFrame(TRACTS), tract_id='census_tract_id')
+    return top_descriptions(description_percentiles(full_df), k=3)
+
+
+def reference(tracts, key, k=3):
+    """Descriptions of one level the way the notebook built them before the single pass."""
+    sums = tracts.groupby(key)[DESCRIPTION_COLS].sum()
+    # percent_rank: (rank - 1) / (rows - 1), ties sharing their lowest rank
+    pct = (sums.rank(method='min') - 1) / max(len(sums) - 1, 1)
+    top = (pct.reset_index()
+           .melt(id_vars=[key])
+           .groupby(key)
+           .apply(lambda x: x.nlargest(k, columns=['value'])))
+    top['description'] = top['variable'] + ': ' + (top['value'] * 100).astype(int).astype(str) + '%'
+    return ('Ranks highly in: ' + top.groupby(level=0)['description'].agg(', '.join)).rename('description')
+
+
+def level_tracts():
+    return TRACTS.assign(county_fips=TRACTS['census_tract_id'].astype(str).str.zfill(11).str[:5])
+
+
+@pytest.mark.parametrize('level', list(DESCRIPTION_LEVELS))
+def test_level_descriptions_match_per_level_ranking(descriptions, level):
+    key = DESCRIPTION_LEVELS[level]
+    actual = level_descriptions(descriptions, level).toPandas().set_index(key)['description']
+    assert actual.to_dict() == reference(level_tracts(), key).to_dict()
+
+
+@pytest.mark.parametrize('level', list(DESCRIPTION_LEVELS))
+def test_level_descriptions_match_incremental_describe(descriptions, level):
+    key = DESCRIPTION_LEVELS[level]
+    actual = level_descriptions(descriptions, level).toPandas().set_index(key)['description']
+    assert actual.to_dict() == describe(level_tracts().groupby(key)[DESCRIPTION_COLS].sum()).to_dict()
@@ -0,0 +1,133 @@
+"""Reusable Spark stages for the Data Transformation notebook.
+
+The notebook joins the Climate and Economic Justice Screening Tool data
+into ``full_df`` and then describes every location by the metrics in
+which it ranks highest compared with the other locations of the same
+level. The stages here compute those descriptions for all levels
+together without leaving Spark.
+"""
+from pyspark.sql import SparkSession, functions as F
+from pyspark.sql.window import Window
+import pandas as pd
+
+
+DESCRIPTION_COLS = [
+    'PM25', 'Diesel_Particulate',
+    'Asthma',
+    'Household_Income',
+    'Building_Loss_Rate',
+    'Agricultural_Loss_Rate',
+    'Traffic_Proximity'
+]
+
+# Column of full_df each level is grouped by; city names repeat, so cities go by id
+DESCRIPTION_LEVELS = {
+    'census_tract': 'census_tract_id',
+    'state': 'state',
+    'city': 'city_id',
+    'county': 'county_fips'
+}
+
+
+def with_county_fips(df, tract_id='Census_tract_ID'):
+    """Add the (state, county) FIPS code of each tract, the first five digits of its GEOID."""
+    return df.withColumn('county_fips', F.substring(F.lpad(F.col(tract_id).cast('long').cast('string'), 11, '0'), 1, 5))
+
+
+def grouping_ids(key_cols):
+    """Return the ``grouping_id()`` Spark assigns to each single-column grouping set."""
+    n = len(key_cols)
+    return {
+        key: sum(1 << (n - 1 - j) for j in range(n) if j != i)
+        for i, key in enumerate(key_cols)
+    }
+
+
+def description_percentiles(full_df, levels=DESCRIPTION_LEVELS, metrics=DESCRIPTION_COLS):
+    """Percent-rank the per-location metric sums of every level in one pass.
+
+    All levels are aggregated by a single ``GROUPING SETS`` query, the
+    metric columns are unpivoted with ``stack`` and ``percent_rank`` runs
+    over one window partitioned by level and metric. This replaces seven
+    unpartitioned windows per level while giving the same values.
+    Rows without a key for a level (tracts without a city) are not a
+    location of that level, as in the incremental ranking.
+
+    Returns a long frame with a ``grouping_id`` column identifying the
+    level, the level key columns (null outside their own level),
+    ``variable`` (the metric name) and ``value`` (its percentile).
+    """
+    key_cols = list(levels.values())
+    view = 'full_df_descriptions'
+    full_df.createOrReplaceTempView(view)
+    sums = SparkSession.builder.getOrCreate().sql(f"""
+        SELECT grouping_id({', '.join(key_cols)}) AS grouping_id,
+               {', '.join(f'{k} AS {k}' for k in key_cols)},
+               {', '.join(f'sum({m}) AS {m}' for m in metrics)}
+        FROM {view}
+        GROUP BY GROUPING SETS ({', '.join(f'({k})' for k in key_cols)})
+        HAVING {' AND '.join(f'(grouping({k}) = 1 OR {k} IS NOT NULL)' for k in key_cols)}
+    """)
+
+    stacked = ', '.join(f"'{m}', CAST({m} AS DOUBLE)" for m in metrics)
+    long_df = sums.select(
+        'grouping_id', *key_cols,
+        F.expr(f'stack({len(metrics)}, {stacked}) AS (variable, value)')
+    )
+    window = Window.partitionBy('grouping_id', 'variable').orderBy('value')
+    return long_df.withColumn('value', F.percent_rank().over(window))
+
+
+def top_descriptions(percentiles_df, k=3, levels=DESCRIPTION_LEVELS, metrics=DESCRIPTION_COLS):
+    """Describe each location by its ``k`` highest percentiles.
+
+    Takes the long output of ``description_percentiles`` and keeps the top
+    ``k`` metrics per location with a ``row_number`` window. Ties go to
+    the metric listed first, like ``DataFrame.nlargest(keep='first')``.
+    Returns ``grouping_id``, the level key columns and ``description``,
+    e.g. ``'Ranks highly in: PM25: 99%, Asthma: 97%, ...'``.
+    """
+    key_cols = list(levels.values())
+    order = F.array_position(F.array(*[F.lit(m) for m in metrics]), F.col('variable'))
+    window = (Window
+              .partitionBy('grouping_id', *key_cols)
+              .orderBy(F.col('value').desc(), order))
+
+    ranked = (percentiles_df
+              .withColumn('position', F.row_number().over(window))
+              .filter(F.col('position') <= k)
+              .withColumn('description', F.concat(F.col('variable'), F.lit(': '), (F.col('value') * 100).cast('int'), F.lit('%')))
+             )
+    return (ranked
+            .groupBy('grouping_id', *key_cols)
+            .agg(F.sort_array(F.collect_list(F.struct('position', 'description'))).alias('description'))
+            .withColumn('description', F.concat(F.lit('Ranks highly in: '), F.concat_ws(', ', F.col('description.description'))))
+           )
+
+
+def level_descriptions(descriptions_df, level, levels=DESCRIPTION_LEVELS):
+    """Select one level of ``top_descriptions`` as ``(key, description)``."""
+    key = levels[level]
+    gid = grouping_ids(list(levels.values()))[key]
+    return (descriptions_df
+            .filter(F.col('grouping_id') == gid)
+            .select(key, 'description')
+           )
+
+
+def compare_with_centres(final_df, centres_path, key):
+    """Return the shipped centres rows whose rank or description differ.
+
+    ``final_df`` is a level's ``*_final`` frame and ``centres_path`` the
+    CSV the dashboard currently serves for that level. Only locations in
+    the CSV are compared, so an empty result means the pipeline reproduces
+    what is deployed.
+    """
+    shipped = pd.read_csv(centres_path)
+    cols = [c for c in ('rank', 'description') if c in shipped]
+    final = final_df.select(key, *cols).toPandas()
+    merged = shipped[[key, *cols]].merge(final, on=key, how='left', suffixes=('_shipped', ''))
+    differs = pd.Series(False, index=merged.index)
+    for c in cols:
+        differs |= ~((merged[c] == merged[f'{c}_shipped']) | (merged[c].isna() & merged[f'{c}_shipped'].isna()))
+    return merged[differs]